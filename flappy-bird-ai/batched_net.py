@@ -0,0 +1,84 @@
+import neat
+import numpy as np
+
+
+class BatchedNetwork:
+    # A whole generation of NEAT feed-forward networks, evaluated together. Each
+    # network's node values are one row of an array, and its nodes are grouped by
+    # depth; for every depth the nodes of all networks are computed at once from
+    # weight tensors padded to the largest network, shape (networks, nodes, values).
+    #
+    # The networks are built by neat.nn.FeedForwardNetwork.create, so which nodes
+    # are evaluated and with which weights is exactly what activate() would use.
+    # Only the tanh activation and sum aggregation of config.ini are supported.
+
+    def __init__(self, genomes, config):
+        genome_config = config.genome_config
+        tanh = genome_config.activation_defs.get("tanh")
+        total = genome_config.aggregation_function_defs.get("sum")
+        n_inputs = len(genome_config.input_keys)
+        n_outputs = len(genome_config.output_keys)
+
+        nets = []
+        for genome in genomes:
+            net = neat.nn.FeedForwardNetwork.create(genome, config)
+            # inputs and outputs come first, so they are in the same columns for all
+            slots = {key: i for i, key in enumerate(net.input_nodes + net.output_nodes)}
+            depths = {}
+            nodes = []
+            for node, activation, aggregation, bias, response, links in net.node_evals:
+                if activation is not tanh or aggregation is not total:
+                    raise ValueError(
+                        "only tanh activation and sum aggregation are supported"
+                    )
+                depth = 1 + max((depths.get(i, 0) for i, _ in links), default=0)
+                depths[node] = depth
+                slots.setdefault(node, len(slots))
+                links = [(slots[i], w) for i, w in links]
+                nodes.append((depth, slots[node], bias, response, links))
+            nets.append((len(slots), nodes))
+
+        self.n_inputs = n_inputs
+        self.outputs = np.arange(n_inputs, n_inputs + n_outputs)
+        # one spare column takes the padding nodes' values
+        self.width = max(n_slots for n_slots, _ in nets) + 1
+        depth = max((node[0] for _, nodes in nets for node in nodes), default=0)
+        self.layers = []
+        for d in range(1, depth + 1):
+            layer = [[node for node in nodes if node[0] == d] for _, nodes in nets]
+            size = max(len(nodes) for nodes in layer)
+            weights = np.zeros((len(nets), size, self.width))
+            bias = np.zeros((len(nets), size))
+            response = np.zeros((len(nets), size))
+            target = np.full((len(nets), size), self.width - 1)
+            for n, nodes in enumerate(layer):
+                for k, (_, slot, b, r, links) in enumerate(nodes):
+                    bias[n, k] = b
+                    response[n, k] = r
+                    target[n, k] = slot
+                    for i, w in links:
+                        weights[n, k, i] = w
+            self.layers.append((weights, bias, response, target))
+        self.rows = None
+        self.subset = self.layers
+
+    def activate(self, inputs, rows=None):
+        # inputs has one row per network (or per network in rows); returns the
+        # outputs in the same order
+        inputs = np.asarray(inputs, dtype=float)
+        layers = self.layers
+        if rows is not None:
+            # the same birds stay alive for many frames, so keep their weights
+            if self.rows is None or not np.array_equal(rows, self.rows):
+                self.rows = np.array(rows)
+                self.subset = [[a[self.rows] for a in layer] for layer in self.layers]
+            layers = self.subset
+        values = np.zeros((inputs.shape[0], self.width))
+        values[:, : self.n_inputs] = inputs
+        row = np.arange(inputs.shape[0])[:, None]
+        for weights, bias, response, target in layers:
+            s = np.matmul(weights, values[:, :, None])[:, :, 0]
+            # neat's tanh_activation (it clamps 2.5 z to +-60 first, where tanh is
+            # already +-1 in double precision)
+            values[row, target] = np.tanh(2.5 * (bias + response * s))
+        return values[:, self.outputs]
@@ -0,0 +1,104 @@
+# A vectorised Flappy Bird environment for training agents other than NEAT: K
+# independent games of one bird each, advanced in lockstep by array operations,
+# with a gym-like reset() / step(actions) interface.
+#
+# The rules are game.py's. Since every game spawns a pipe each Pipe.spawn_frames
+# frames and pipes move a pixel a frame, a pipe's position follows from the
+# frame number alone: pipe n is spawned at frame n * spawn_frames, and at most
+# two are on screen, so only their gap heights are stored (slot n % 2).
+import numpy as np
+
+from game import Bird, H, Pipe, floor_y, g, round_pixel
+
+
+class VectorEnv:
+    # observation columns, as flappy_ml feeds its networks: bird y, bird dy, x of
+    # the next pipe and y of its gap centre
+    n_observations = 4
+    frame_reward = 0.02  # flappy_ml's cont_score_increment; each point is 1 more
+
+    def __init__(self, n_games, seed=None):
+        self.n_games = n_games
+        self.rng = np.random.default_rng(seed)
+        self.y = np.zeros(n_games, dtype=np.int64)
+        self.dy = np.zeros(n_games)
+        self.frame = np.zeros(n_games, dtype=np.int64)
+        self.score = np.zeros(n_games, dtype=np.int64)
+        self.score_timeout = np.zeros(n_games, dtype=bool)
+        self.heights = np.zeros((n_games, 2), dtype=np.int64)
+        self.games = np.arange(n_games)
+
+    def spawn_pipes(self, games):
+        # the same range as Game.spawn_pipe's randint
+        n = self.frame[games] // Pipe.spawn_frames
+        self.heights[games, n % 2] = self.rng.integers(
+            int(0.2 * H), int(0.6 * H) + 1, len(games)
+        )
+
+    def reset_games(self, games):
+        self.y[games] = Bird.start_y
+        self.dy[games] = 0
+        self.frame[games] = 0
+        self.score[games] = 0
+        self.score_timeout[games] = False
+        self.spawn_pipes(games)
+
+    def reset(self):
+        self.reset_games(self.games)
+        return self.observations()
+
+    def pipe_x(self, n):
+        # centre of each game's pipe n (an array), spawned at Pipe.spawn_x
+        return Pipe.spawn_x - (self.frame - n * Pipe.spawn_frames)
+
+    def observations(self):
+        # Game.next_pipe: the older pipe if it is on screen and not 10 px behind
+        n = self.frame // Pipe.spawn_frames
+        older = (n > 0) & (self.pipe_x(n - 1) + Pipe.width // 2 + 10 >= Bird.start_x)
+        n = n - older
+        observations = np.empty((self.n_games, self.n_observations))
+        observations[:, 0] = self.y
+        observations[:, 1] = self.dy
+        observations[:, 2] = self.pipe_x(n)
+        observations[:, 3] = self.heights[self.games, n % 2]
+        return observations
+
+    def step(self, actions):
+        # actions[i] makes the bird of game i flap. Returns the observations, the
+        # rewards, which games ended and {"score": ...}, the scores before any game
+        # was reset; ended games are reset, so their observations are of a new game
+        self.frame += 1
+        flaps = np.asarray(actions, dtype=bool)
+        self.dy[flaps] = -Bird.jump_impulse
+
+        # the pipes spawned before this frame; the older one of the two may have
+        # despawned, but then it is too far behind the bird to matter
+        n = (self.frame - 1) // Pipe.spawn_frames
+        top = self.y - Bird.height // 2
+        bottom = top + Bird.height
+        hit = (top <= -100) | (bottom >= floor_y)
+        scored = np.zeros(self.n_games, dtype=bool)
+        for m in (n - 1, n):
+            x = self.pipe_x(m)
+            gap_y = self.heights[self.games, m % 2]
+            left, right = x - Pipe.width // 2, x + Pipe.width // 2
+            column = (m >= 0) & (Bird.left < right) & (left < Bird.right)
+            hit |= column & (top < gap_y - Pipe.spacing_y // 2)
+            hit |= column & (bottom > gap_y + Pipe.spacing_y // 2)
+            scored |= (m >= 0) & (Bird.start_x - 5 < x) & (x < Bird.start_x + 5)
+
+        alive = ~hit
+        self.y[alive] = round_pixel(self.y[alive] + self.dy[alive])
+        self.dy[alive] = np.minimum(Bird.max_dy, self.dy[alive] + g)
+
+        points = scored & ~self.score_timeout
+        self.score += points
+        self.score_timeout = scored
+        rewards = points + self.frame_reward * alive
+        info = {"score": self.score.copy()}
+
+        spawning = np.flatnonzero(self.frame % Pipe.spawn_frames == 0)
+        self.spawn_pipes(spawning)
+        done = np.flatnonzero(hit)
+        self.reset_games(done)
+        return self.observations(), rewards, hit, info
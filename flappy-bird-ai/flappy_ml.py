@@ -1,110 +1,157 @@
+import argparse
+import glob
+import multiprocessing
 import neat
+import numpy as np
+import os
 import pickle
-import pygame
+import random
 import sys
+import time
 
-# This line inits pygame too
-from flap import Bird, Floor, Pipe, Score, Background, Sounds, clock, screen, font
+from batched_net import BatchedNetwork
+from game import Bird, Game
 
-Sounds.play_sounds = False
+render = True  # draw the game in real time, or run headless as fast as possible
+render_every = 1  # generations; the others run headless
+frame_skip = 1  # draw one frame in this many, which plays that many times faster
+best_only = False  # draw only the best bird still alive
 gen_number = 0
+seed = None  # pipe layouts are seeded per generation from this; random if None
+workers = 1  # processes sharing each generation; more than one needs headless games
 cont_score_increment = 0.02
+generations = 300
+checkpoint_every = 10  # generations
+checkpoint_prefix = "checkpoints/neat-checkpoint-"
+seed_file = "checkpoints/seed"  # the seed of the run the checkpoints belong to
+winner_file = "winner.pkl"
 
 
 def draw_gen_number(gen_number, x=50, y=25):
+    from flap import font, screen
+
     surface = font.render(f"Gen: {int(gen_number)}", False, (255, 255, 255))
     rect = surface.get_rect(center=(x, y))
     screen.blit(surface, rect)
 
 
-def get_pipe_params(pipes, bird_x):
-    for pipe in pipes:
-        if pipe.rect.topright[0] + 10 >= bird_x:
-            break
-
-    return (
-        pipe.rect.centerx,
-        (pipe.rect.midtop[1] + pipe.rect_inv.midbottom[1]) / 2,
-    )
+def generation_rng(gen_number):
+    # every game of a generation gets the same pipes, however the genomes are split
+    return random.Random(f"{seed}-{gen_number}")
 
 
-def eval_genomes(genomes, config):
-    global gen_number
-    gen_number += 1
+def play(genomes, config, rng, render=False, gen_number=0, game=None):
+    # one game with a bird per genome, until they all die; returns their fitness
 
     # init game variables
-    game_active = True
-    framerate = 144
     cont_score = 0
+    if game is None:
+        game = Game(len(genomes), rng=rng)
+    nets = BatchedNetwork(genomes, config)
+    fitness = np.zeros(len(genomes))
 
-    # init pipes logic
-    SPAWNPIPE = pygame.USEREVENT
-    pygame.time.set_timer(SPAWNPIPE, framerate * 10)
+    if render:
+        import pygame
+        import flap
 
-    pipes = [Pipe()]
-    floor = Floor()
-    birds = [(i, Bird()) for i in range(len(genomes))]
-    nets = [
-        (i, neat.nn.FeedForwardNetwork.create(genome, config)) for i, genome in genomes
-    ]
+        flap.init()
+        flap.Sounds.play_sounds = False
+        sprites = [flap.Bird() for _ in genomes]
+        # best by last generation's fitness, which only the survivors have
+        ranking = sorted(
+            range(len(genomes)),
+            key=lambda i: -np.inf if genomes[i].fitness is None else genomes[i].fitness,
+            reverse=True,
+        )
 
     # GAME LOOP
     while True:
         cont_score += cont_score_increment
 
         # event loop
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-
-            if event.type == SPAWNPIPE:
-                pipes.append(Pipe())
-
-        for bird_id, bird in birds:
-            inputs = [
-                bird.rect.centery,
-                bird.dy,
-                Bird.start_x,
-                *get_pipe_params(pipes, Bird.start_x),
-            ]
-            output = nets[bird_id][1].activate(inputs)
-            if output[0] > 0.5:
-                bird.dy = -Bird.jump_impulse
-            genomes[bird_id][1].fitness = Score.score + cont_score
-
-        Background.draw()
-
-        if not birds:
-            Score.reset()
-            break
-
-        # draw, animate pipes, then despawn old pipes
-        for pipe in pipes:
-            pipe.draw()
-            if game_active:
-                pipe.update()
-        pipes = [pipe for pipe in pipes if pipe.rect.right > Pipe.despawn_x]
-
-        floor.draw()
-        for bird in birds:
-            bird[1].draw()
-        Score.draw(game_active, x=260, y=25)
-        draw_gen_number(gen_number)
-
-        birds[:] = [bird for bird in birds if bird[1].check_collisions(pipes)]
-
-        for bird in birds:
-            bird[1].update()
-        floor.update()
-        Score.update(pipes)
-
-        pygame.display.update()
-        clock.tick(framerate)
-
-
-def run(config_file):
-    config = neat.Config(
+        if render:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    pygame.quit()
+                    sys.exit()
+
+        # every bird is at the same x, so they all see the same pipe
+        pipe = game.next_pipe
+        alive = np.flatnonzero(game.alive)
+        inputs = np.empty((len(alive), 5))
+        inputs[:, 0] = game.y[alive]
+        inputs[:, 1] = game.dy[alive]
+        inputs[:, 2:] = Bird.start_x, pipe.x, pipe.y
+        output = nets.activate(inputs, alive)
+        flaps = np.zeros(len(genomes), dtype=bool)
+        flaps[alive] = output[:, 0] > 0.5
+        fitness[alive] = game.score + cont_score
+
+        # a bird good enough to end the run could otherwise fly forever
+        if game.over or game.score + cont_score >= config.fitness_threshold:
+            return fitness
+
+        game.step(flaps)
+
+        if render and game.frame % frame_skip == 0:
+            shown = None
+            if best_only:
+                shown = [i for i in ranking if game.alive[i]][:1]
+            flap.draw_game(game, sprites, shown=shown)
+            flap.Score.draw(game, True, x=260, y=25)
+            if gen_number is not None:
+                draw_gen_number(gen_number)
+
+            pygame.display.update()
+            flap.clock.tick(flap.framerate)
+
+
+def eval_genomes(genomes, config):
+    global gen_number
+    gen_number += 1
+
+    fitness = play(
+        [genome for _, genome in genomes],
+        config,
+        generation_rng(gen_number),
+        render and (gen_number - 1) % render_every == 0,
+        gen_number,
+    )
+    for (_, genome), f in zip(genomes, fitness.tolist()):
+        genome.fitness = f
+
+
+class ShardedEvaluator:
+    # Splits each generation over a process pool. Every worker plays its share of
+    # the genomes in its own headless game with the generation's pipe layout, so
+    # the fitness of each genome is the same as in a single game.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = multiprocessing.Pool(workers)
+
+    def eval_genomes(self, genomes, config):
+        global gen_number
+        gen_number += 1
+
+        shards = [genomes[i :: self.workers] for i in range(self.workers)]
+        rng = generation_rng(gen_number)
+        jobs = [
+            self.pool.apply_async(play, ([genome for _, genome in shard], config, rng))
+            for shard in shards
+            if shard
+        ]
+        for shard, job in zip(shards, jobs):
+            for (_, genome), f in zip(shard, job.get().tolist()):
+                genome.fitness = f
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def load_config(config_file):
+    return neat.Config(
         neat.DefaultGenome,
         neat.DefaultReproduction,
         neat.DefaultSpeciesSet,
@@ -112,13 +159,133 @@ def run(config_file):
         config_file,
     )
 
-    p = neat.Population(config)
+
+def latest_checkpoint():
+    # checkpoints are named after the generation they resume at
+    paths = glob.glob(checkpoint_prefix + "*")
+    if not paths:
+        sys.exit(f"No checkpoints found at {checkpoint_prefix}*")
+    return max(paths, key=lambda path: int(path[len(checkpoint_prefix) :]))
+
+
+def run(config_file, resume=False):
+    global gen_number, seed
+
+    if resume:
+        path = latest_checkpoint()
+        print(f"Resuming from {path}")
+        p = neat.Checkpointer.restore_checkpoint(path)
+    else:
+        p = neat.Population(load_config(config_file))
+    gen_number = p.generation
+    remaining = generations - p.generation
+    if remaining <= 0:
+        print(f"Generation {p.generation} already reached {generations}, not training")
+        return
 
     p.add_reporter(neat.StdOutReporter(True))
     p.add_reporter(neat.StatisticsReporter())
+    os.makedirs(os.path.dirname(checkpoint_prefix), exist_ok=True)
+    p.add_reporter(
+        neat.Checkpointer(checkpoint_every, filename_prefix=checkpoint_prefix)
+    )
+
+    # a resumed run carries on with the pipe layouts of the run it was saved from
+    if resume and os.path.exists(seed_file):
+        with open(seed_file) as f:
+            saved = int(f.read())
+        if seed is not None and seed != saved:
+            print(f"Ignoring --seed {seed}, the checkpoints were made with {saved}")
+        seed = saved
+    elif seed is None:
+        seed = random.randrange(2**32)
+    with open(seed_file, "w") as f:
+        f.write(f"{seed}\n")
+    print(f"Pipe layout seed: {seed}")
+
+    if workers > 1:
+        evaluator = ShardedEvaluator(workers)
+        winner = p.run(evaluator.eval_genomes, remaining)
+        evaluator.close()
+    else:
+        winner = p.run(eval_genomes, remaining)
+
+    # never replace a saved winner with nothing
+    if winner is None:
+        print(f"No winner, {winner_file} left as it was")
+        return
+    with open(winner_file, "wb") as f:
+        pickle.dump(winner, f)
+    print(f"Saved the winner to {winner_file}")
 
-    winner = p.run(eval_genomes, 300)
+
+def replay(config_file, benchmark=False):
+    # the saved winner plays one game (on --seed's pipes), until it dies or reaches
+    # the fitness threshold; the benchmark runs it headless and times it
+    config = load_config(config_file)
+    with open(winner_file, "rb") as f:
+        winner = pickle.load(f)
+
+    game = Game(seed=seed)
+    start = time.perf_counter()
+    fitness = play([winner], config, None, not benchmark, None, game)
+    elapsed = time.perf_counter() - start
+    print(f"Score: {game.score}, fitness: {fitness[0]:.2f}")
+    if benchmark:
+        print(
+            f"{game.frame} frames in {elapsed:.2f} s: {game.frame / elapsed:.0f} FPS"
+        )
 
 
 if __name__ == "__main__":
-    run("config.ini")
+    parser = argparse.ArgumentParser(description="Evolve a Flappy Bird AI with NEAT")
+    parser.add_argument(
+        "--headless", action="store_true", help="train without a window, unthrottled"
+    )
+    parser.add_argument(
+        "--render-every",
+        type=int,
+        default=render_every,
+        metavar="N",
+        help="draw one generation in N, running the rest headless",
+    )
+    parser.add_argument(
+        "--frame-skip",
+        type=int,
+        default=frame_skip,
+        metavar="K",
+        help="draw one frame in K, so the game plays K times faster",
+    )
+    parser.add_argument(
+        "--best-only", action="store_true", help="draw only the best living bird"
+    )
+    parser.add_argument("--seed", type=int, help="seed for the pipe layouts")
+    parser.add_argument(
+        "--resume", action="store_true", help="continue from the latest checkpoint"
+    )
+    parser.add_argument(
+        "--replay", action="store_true", help=f"watch the winner in {winner_file}"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="replay the winner headless and report the frame rate",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=workers,
+        help="processes sharing each generation (0: one per core), implies --headless",
+    )
+    args = parser.parse_args()
+    workers = args.workers or multiprocessing.cpu_count()
+    render = not args.headless and workers == 1
+    render_every = args.render_every
+    frame_skip = args.frame_skip
+    best_only = args.best_only
+    seed = args.seed
+
+    if args.replay or args.benchmark:
+        replay("config.ini", args.benchmark)
+    else:
+        run("config.ini", args.resume)
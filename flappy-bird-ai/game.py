@@ -0,0 +1,177 @@
+# Flappy Bird game logic without pygame: birds, pipes, floor and scoring as plain
+# numbers and arrays, advanced one frame at a time by Game.step. Positions are
+# whole pixels and rounded the way pygame.Rect rounds, so the game plays exactly
+# like flap.py.
+# Drawing and sound are left to observers (see flap.py), which read the state
+# and the events of the last step.
+#
+# All birds share one x position, so the whole population is kept in arrays
+# (y, dy, alive) and every frame is a few array operations however many birds
+# there are. The pipes are kept in a deque, oldest (leftmost) first, with the
+# index of the next pipe ahead of the birds, so that only it and the one before
+# it are ever checked.
+from collections import deque
+import numpy as np
+import random
+
+W, H = 288, 512
+floor_y = H - 112
+g = 0.125
+
+
+def round_pixel(value):
+    # pygame.Rect rounds half away from zero
+    return np.copysign(np.floor(np.abs(value) + 0.5), value).astype(np.int64)
+
+
+class Bird:
+    start_x = 50
+    start_y = H // 3
+    max_dy = 6
+    jump_impulse = 4
+    width, height = 34, 24
+    left = start_x - width // 2
+    right = left + width
+
+
+class Pipe:
+    spacing_y = 150
+    despawn_x = -30
+    spawn_x = W + 30
+    spawn_frames = 207  # 1440 ms at 144 FPS
+    width, height = 52, 320
+
+    def __init__(self, y):
+        self.x = type(self).spawn_x  # centre
+        self.y = y  # centre of the gap
+
+    @property
+    def left(self):
+        return self.x - type(self).width // 2
+
+    @property
+    def right(self):
+        return self.left + type(self).width
+
+    def update(self):
+        self.x -= 1
+
+
+class Game:
+    def __init__(self, n_birds=1, seed=None, rng=None):
+        # the pipe heights are all that is random, so a seed (or a random.Random)
+        # fixes the whole course
+        self.seed = seed
+        self.rng = rng
+        self.y = np.full(n_birds, Bird.start_y, dtype=np.int64)  # centres
+        self.dy = np.zeros(n_birds)
+        self.alive = np.ones(n_birds, dtype=bool)
+        self.pipes = deque()
+        self.floor_x = 0
+        self.high_score = 0
+        self.reset()
+
+    def spawn_pipe(self):
+        self.pipes.append(Pipe(self.rng.randint(int(0.2 * H), int(0.6 * H))))
+        self.update_next_pipe()
+
+    def update_next_pipe(self):
+        # the first pipe whose right edge is at most 10 px behind the birds, or the
+        # last one; its distance and gap are what the AI sees
+        while (
+            self.next_index < len(self.pipes) - 1
+            and self.pipes[self.next_index].right + 10 < Bird.start_x
+        ):
+            self.next_index += 1
+
+    @property
+    def next_pipe(self):
+        return self.pipes[self.next_index]
+
+    @property
+    def over(self):
+        return not self.alive.any()
+
+    def reset(self, seed=None):
+        # a seeded game (or one given a new seed here) starts its course over; an
+        # unseeded one draws a new course, or carries on with the rng it was given
+        if seed is not None:
+            self.seed = seed
+        if self.seed is not None or self.rng is None:
+            self.rng = random.Random(self.seed)
+        self.y[:] = Bird.start_y
+        self.dy[:] = 0
+        self.alive[:] = True
+        self.pipes.clear()
+        self.next_index = 0
+        self.spawn_pipe()
+        self.score = 0
+        self.score_timeout = False
+        self.frame = 0
+        self.events = []  # "flap", "die" and "point", for sounds
+
+    def collisions(self):
+        top = self.y - Bird.height // 2
+        bottom = top + Bird.height
+        hit = (top <= -100) | (bottom >= floor_y)
+        # pipes before the next one but still under the birds are less than 10 px
+        # behind, so one before it at most
+        for i in range(max(self.next_index - 1, 0), len(self.pipes)):
+            pipe = self.pipes[i]
+            if pipe.left >= Bird.right:
+                break
+            if Bird.left < pipe.right:
+                # the gap is the only part of the pipe's column a bird may be in
+                hit |= top < pipe.y - Pipe.spacing_y // 2
+                hit |= bottom > pipe.y + Pipe.spacing_y // 2
+        return hit
+
+    def step(self, flaps=False):
+        # flaps[i] (or flaps, for every bird) makes bird i flap this frame
+        self.frame += 1
+        self.events = []
+        flaps = np.asarray(flaps, dtype=bool) & self.alive
+        if flaps.any():
+            self.dy[flaps] = -Bird.jump_impulse
+            self.events.append("flap")
+
+        for pipe in self.pipes:
+            pipe.update()
+        while self.pipes and self.pipes[0].right <= Pipe.despawn_x:
+            self.pipes.popleft()
+            self.next_index -= 1
+        self.next_index = max(self.next_index, 0)
+        self.update_next_pipe()
+
+        dying = self.alive & self.collisions()
+        if dying.any():
+            self.alive &= ~dying
+            self.events.append("die")
+        alive = self.alive
+        self.y[alive] = round_pixel(self.y[alive] + self.dy[alive])
+        self.dy[alive] = np.minimum(Bird.max_dy, self.dy[alive] + g)
+
+        self.floor_x -= 1
+        if self.floor_x <= -W:
+            self.floor_x = 0
+        self.update_score()
+
+        # spawned for the next frame, so it is seen before it first moves
+        if self.frame % Pipe.spawn_frames == 0:
+            self.spawn_pipe()
+
+    def update_score(self):
+        # a pipe over the birds is not behind the next one
+        for i in range(self.next_index, len(self.pipes)):
+            pipe = self.pipes[i]
+            if pipe.x >= Bird.start_x + 5:
+                break
+            if Bird.start_x - 5 < pipe.x:
+                if not self.score_timeout:
+                    self.score += 1
+                    self.events.append("point")
+                self.score_timeout = True
+                return
+        self.score_timeout = False
+
+        self.high_score = max(self.score, self.high_score)
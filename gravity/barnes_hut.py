@@ -0,0 +1,180 @@
+import numpy as np
+from numba import njit, prange
+
+from jit import njitVariant
+
+# The quadtree is stored as flat arrays indexed by node. Internal nodes hold four child indices (-1 for an empty
+# quadrant); leaves hold a linked list of bodies, which is normally a single body and only grows when bodies
+# sit closer together than maxDepth subdivisions can separate.
+maxDepth = 40
+
+
+@njit(cache=True, nogil=True)
+def _grow(children, leaf_head, centre, half):
+    capacity = 2 * children.shape[0]
+    new_children = np.full((capacity, 4), -1, dtype=np.int32)
+    new_children[: children.shape[0]] = children
+    new_leaf_head = np.full(capacity, -1, dtype=np.int32)
+    new_leaf_head[: leaf_head.shape[0]] = leaf_head
+    new_centre = np.zeros((capacity, 2), dtype=np.float64)
+    new_centre[: centre.shape[0]] = centre
+    new_half = np.zeros(capacity, dtype=np.float64)
+    new_half[: half.shape[0]] = half
+    return new_children, new_leaf_head, new_centre, new_half
+
+
+@njit(cache=True, nogil=True)
+def buildTree(r, m):
+    """Build the quadtree for positions r and masses m.
+
+    Returns (children, leaf_head, next_body, half, mass, com, node_count). A node is a leaf when all of its
+    children are -1; leaf_head gives the first body of a leaf and next_body chains the rest.
+    """
+    n = r.shape[0]
+    capacity = max(64, 2 * n)
+    children = np.full((capacity, 4), -1, dtype=np.int32)
+    leaf_head = np.full(capacity, -1, dtype=np.int32)
+    centre = np.zeros((capacity, 2), dtype=np.float64)
+    half = np.zeros(capacity, dtype=np.float64)
+    next_body = np.full(n, -1, dtype=np.int32)
+    node_count = 1
+
+    if n > 0:
+        x_min = r[:, 0].min()
+        x_max = r[:, 0].max()
+        y_min = r[:, 1].min()
+        y_max = r[:, 1].max()
+        centre[0, 0] = 0.5 * (x_min + x_max)
+        centre[0, 1] = 0.5 * (y_min + y_max)
+        half[0] = 0.5 * max(x_max - x_min, y_max - y_min) * 1.0001 + 1e-3
+
+    for i in range(n):
+        body = i
+        node = 0
+        depth = 0
+        while True:
+            internal = children[node, 0] != -1 or children[node, 1] != -1
+            internal = internal or children[node, 2] != -1 or children[node, 3] != -1
+            if not internal:
+                if leaf_head[node] == -1:
+                    leaf_head[node] = body
+                    break
+                if depth >= maxDepth:
+                    next_body[body] = leaf_head[node]
+                    leaf_head[node] = body
+                    break
+                # occupied leaf: push its body one level down, then carry on inserting into the new subtree
+                other = leaf_head[node]
+                leaf_head[node] = -1
+                q = (1 if r[other, 0] >= centre[node, 0] else 0) + (2 if r[other, 1] >= centre[node, 1] else 0)
+            else:
+                q = (1 if r[body, 0] >= centre[node, 0] else 0) + (2 if r[body, 1] >= centre[node, 1] else 0)
+                if children[node, q] != -1:
+                    node = children[node, q]
+                    depth += 1
+                    continue
+                other = body
+
+            if node_count == children.shape[0]:
+                children, leaf_head, centre, half = _grow(children, leaf_head, centre, half)
+            child = node_count
+            node_count += 1
+            h = 0.5 * half[node]
+            centre[child, 0] = centre[node, 0] + (h if q & 1 else -h)
+            centre[child, 1] = centre[node, 1] + (h if q & 2 else -h)
+            half[child] = h
+            children[node, q] = child
+            leaf_head[child] = other
+            if other == body:
+                break
+
+    # children always have larger indices than their parent, so a reverse sweep sees them first
+    mass = np.zeros(node_count, dtype=np.float64)
+    com = np.zeros((node_count, 2), dtype=np.float64)
+    for node in range(node_count - 1, -1, -1):
+        node_m = 0.0
+        node_x = 0.0
+        node_y = 0.0
+        j = leaf_head[node]
+        while j != -1:
+            node_m += m[j]
+            node_x += m[j] * r[j, 0]
+            node_y += m[j] * r[j, 1]
+            j = next_body[j]
+        for q in range(4):
+            child = children[node, q]
+            if child != -1:
+                node_m += mass[child]
+                node_x += mass[child] * com[child, 0]
+                node_y += mass[child] * com[child, 1]
+        mass[node] = node_m
+        if node_m > 0:
+            com[node, 0] = node_x / node_m
+            com[node, 1] = node_y / node_m
+        else:
+            com[node, 0] = centre[node, 0]
+            com[node, 1] = centre[node, 1]
+
+    return children[:node_count], leaf_head[:node_count], next_body, half[:node_count], mass, com, node_count
+
+
+@njit(cache=True, nogil=True)
+def _body_acceleration(i, r, m, children, leaf_head, next_body, half, mass, com, theta, softening, stack):
+    x = r[i, 0]
+    y = r[i, 1]
+    ax = 0.0
+    ay = 0.0
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if mass[node] == 0:
+            continue
+        dx = com[node, 0] - x
+        dy = com[node, 1] - y
+        d2 = dx * dx + dy * dy
+        if leaf_head[node] != -1:
+            # leaves are summed exactly, skipping the body itself
+            j = leaf_head[node]
+            while j != -1:
+                if j != i:
+                    dx = r[j, 0] - x
+                    dy = r[j, 1] - y
+                    d2 = max(softening, dx * dx + dy * dy)
+                    f = m[j] / (d2 * np.sqrt(d2))
+                    ax += f * dx
+                    ay += f * dy
+                j = next_body[j]
+        elif 4.0 * half[node] * half[node] < theta * theta * d2:
+            d2 = max(softening, d2)
+            f = mass[node] / (d2 * np.sqrt(d2))
+            ax += f * dx
+            ay += f * dy
+        else:
+            for q in range(4):
+                if children[node, q] != -1:
+                    stack[top] = children[node, q]
+                    top += 1
+    return ax, ay
+
+
+def _accelerations(r, m, a, theta, softening, targets):
+    children, leaf_head, next_body, half, mass, com, _ = buildTree(r, m)
+    n = targets.shape[0]
+    block = 256
+    for b in prange((n + block - 1) // block):
+        stack = np.empty(3 * maxDepth + 8, dtype=np.int32)
+        for k in range(b * block, min(n, (b + 1) * block)):
+            i = targets[k]
+            ax, ay = _body_acceleration(
+                i, r, m, children, leaf_head, next_body, half, mass, com, theta, softening, stack
+            )
+            a[i, 0] = ax
+            a[i, 1] = ay
+
+
+# Barnes-Hut approximation of the direct-sum accelerations of the bodies in targets, written into a. The parallel
+# version spreads the tree walks over threads; every body's sum is still done by a single thread.
+accelerations = njitVariant(_accelerations, "accelerations", nogil=True)
+accelerationsParallel = njitVariant(_accelerations, "accelerationsParallel", parallel=True, nogil=True)
@@ -1,8 +1,21 @@
+import time
+
+importStart = time.perf_counter()  # for --profile-startup
+
 import pygame
 from pygame import gfxdraw
 import numpy as np
-from numba import njit
+from numba import njit, prange
+import numba
+from collections import namedtuple
+import argparse
+import csv
 import sys
+import threading
+
+import barnes_hut
+import particle_mesh
+from jit import njitVariant
 
 # Globals
 FRAMERATE = 60
@@ -24,8 +37,33 @@ pathPredictionColour = BLUE
 pathPredictionLength = 1000
 pathPredictionSize = 2
 pathPredictionInterval = 5
+pathPredictionBodies = 250  # heaviest bodies the prediction is integrated against
+pathPredictionBudget = 2_000_000  # body-pair interactions per frame spent rebuilding the prediction
 mouseVelocityFactor = 0.04
 minimumDistance = 20
+physicsSubsteps = 1  # physics steps per frame at FRAMERATE, run on a fixed timestep however fast frames are drawn
+maxCatchUp = 2  # frames' worth of steps run at most per frame; beyond that the simulation slows down instead
+physicsThread = False
+mergeCollisions = False  # overlapping bodies merge inelastically (--merge)
+renderMode = "lod"  # "aa": anti-aliased gfxdraw circles, "points": all plotted in one kernel, "lod": plot small ones
+plotMaxSize = 3  # largest circle plotted without anti-aliasing in "lod" mode
+diskBodies = 1000  # planets added by the D key
+diskMass = 500  # their total mass, however many there are
+startWithDisk = False
+gravityEngine = "direct"  # "direct", "barnes-hut" or "particle-mesh"
+openingAngle = 0.5  # Barnes-Hut theta: smaller is more accurate and slower
+meshSize = 256  # particle-mesh cells across the grid
+meshBoundary = "isolated"  # "isolated": mesh fitted around the bodies, "periodic": the field wraps around
+parallelForces = False
+parallelChunks = 32  # fixed split of the pair loop, so parallel results do not depend on the thread count
+integrator = "euler"  # "euler" (v += a; r += v), "leapfrog" or "block" (leapfrog with per-body block timesteps)
+timeStep = 1.0  # simulated time per step
+blockTimestepLevels = 6  # block timesteps go down to timeStep / 2 ** blockTimestepLevels
+timestepAccuracy = 0.2  # eta in dt = eta * sqrt(softening length / |a|)
+warmUpKernels = True  # compile (or load from numba's cache) every kernel before the first frame
+profileStartup = False
+showHud = False  # timings overlay, toggled with H
+timingWindow = 600  # frames the HUD's rolling percentiles are taken over
 
 
 def getMousePos():
@@ -37,57 +75,741 @@ def drawCircle(pos=None, colour=planetDefaultColour, size=planetDefaultSize):
     if pos is None:
         pos = getMousePos()
     pos = [min(max(screenSize) + 20, max(-20, int(x))) for x in pos]
-    gfxdraw.aacircle(screen, *pos, size, colour)
+    gfxdraw.aacircle(screen, *pos, int(size), colour)
+
+
+def drawCircles(r, colour, size):
+    """Draw many circles at once: those up to plotMaxSize are plotted straight into the screen's pixel buffer by a
+    numba kernel, only bigger ones go through gfxdraw. colour and size may be single values or per-circle arrays."""
+    n = r.shape[0]
+    colour = np.broadcast_to(np.asarray(colour, dtype=np.int64), (n, 3))
+    size = np.broadcast_to(np.asarray(size, dtype=np.int32), (n,))
+    max_size = -1 if renderMode == "aa" else plotMaxSize if renderMode == "lod" else np.iinfo(np.int32).max
+    if max_size >= 0:
+        try:
+            pixels = pygame.surfarray.pixels2d(screen)
+        except ValueError:  # not a 32-bit surface
+            max_size = -1
+        else:
+            shifts = screen.get_shifts()
+            mapped = (colour[:, 0] << shifts[0]) | (colour[:, 1] << shifts[1]) | (colour[:, 2] << shifts[2])
+            mapped = (mapped | screen.get_masks()[3]).astype(np.uint32)
+            _plot(pixels, r, mapped, np.ascontiguousarray(size), max_size)
+            del pixels  # unlocks the screen for gfxdraw
+    for i in np.flatnonzero(size > max_size):
+        drawCircle(pos=r[i], colour=colour[i], size=size[i])
+
+
+@njit(cache=True)
+def _set_pixel(pixels, x, y, colour):
+    if 0 <= x < pixels.shape[0] and 0 <= y < pixels.shape[1]:
+        pixels[x, y] = colour
+
+
+@njit(cache=True)
+def _plot(pixels, r, colour, size, max_size):
+    # midpoint circle outlines, without anti-aliasing
+    for i in range(r.shape[0]):
+        s = size[i]
+        if s > max_size or not (-s <= r[i, 0] < pixels.shape[0] + s and -s <= r[i, 1] < pixels.shape[1] + s):
+            continue
+        cx = int(r[i, 0])
+        cy = int(r[i, 1])
+        if s <= 1:
+            _set_pixel(pixels, cx, cy, colour[i])
+            continue
+        x = s
+        y = 0
+        err = 1 - s
+        while x >= y:
+            _set_pixel(pixels, cx + x, cy + y, colour[i])
+            _set_pixel(pixels, cx + y, cy + x, colour[i])
+            _set_pixel(pixels, cx - y, cy + x, colour[i])
+            _set_pixel(pixels, cx - x, cy + y, colour[i])
+            _set_pixel(pixels, cx - x, cy - y, colour[i])
+            _set_pixel(pixels, cx - y, cy - x, colour[i])
+            _set_pixel(pixels, cx + y, cy - x, colour[i])
+            _set_pixel(pixels, cx + x, cy - y, colour[i])
+            y += 1
+            if err < 0:
+                err += 2 * y + 1
+            else:
+                x -= 1
+                err += 2 * (y - x) + 1
 
 
 def spawnBody(
     r=screenCenter, m=planetDefaultMass, v=(0, 0), colour=planetDefaultColour, size=planetDefaultSize, is_sun=False,
 ):
-    global bodys_m_and_r
-    bodys.append(Body(r=r, m=m, v=v, colour=colour, size=size, is_sun=is_sun))
-    bodys_m_and_r = np.append(bodys_m_and_r, [[m, r[0], r[1]]], axis=0)
+    v = mouseVelocityFactor * np.asarray(v, dtype=np.float32)
+    bodies.add(r=r, m=m, v=v, colour=colour, size=size, fixed=is_sun)
+
+
+def spawnBodies(r, v, m=planetDefaultMass, colour=planetDefaultColour, size=planetDefaultSize):
+    """Bulk spawnBody: r and v are (k, 2) arrays, the other arguments are scalars or per-body arrays."""
+    v = mouseVelocityFactor * np.asarray(v, dtype=np.float32)
+    bodies.addMany(r=r, m=m, v=v, colour=colour, size=size, fixed=False)
+
+
+def spawnDisk(n=None, inner=60, outer=350, centre=screenCenter, mass=None, size=2, seed=None):
+    """Spawn n planets of total mass diskMass spread evenly over an annulus, each on a circular orbit around the centre.
+
+    Planets are placed on free slots of a polar lattice spaced so that no two of them overlap, so the annulus is
+    widened if it cannot fit them all. inner == outer gives a ring. The orbital speed accounts for the sun plus the
+    disk mass inside each radius.
+    """
+    if n is None:
+        n = diskBodies
+    if mass is None:
+        mass = diskMass
+    rng = np.random.default_rng(seed)
+    spacing = 2 * size + 1  # bodies overlap when closer than the sum of their sizes
+    while True:
+        rings = max(1, int((outer - inner) // spacing))
+        radii = inner + (outer - inner) * (np.arange(rings) + 0.5) / rings
+        # as many slots on each ring as fit with chords of at least the spacing
+        slots = np.floor(np.pi / np.arcsin(np.minimum(1, spacing / (2 * np.maximum(radii, spacing))))).astype(np.int64)
+        if slots.sum() >= n:
+            break
+        outer += spacing
+    chosen = rng.choice(slots.sum(), n, replace=False)
+    ring = np.searchsorted(np.cumsum(slots), chosen, side="right")
+    slot = chosen - (np.cumsum(slots) - slots)[ring]
+    radius = radii[ring]
+    angle = 2 * np.pi * (slot + rng.random(rings)[ring]) / slots[ring]  # each ring turned by a random angle
+    direction = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    m = mass / n
+    enclosed = sunDefaultMass + mass * (radius ** 2 - inner ** 2) / max(outer ** 2 - inner ** 2, 1)
+    speed = np.sqrt(enclosed * radius ** 2 / np.maximum(minimumDistance, radius ** 2) ** 1.5)
+    r = np.asarray(centre, dtype=np.float32) + radius[:, None] * direction
+    v = speed[:, None] * np.stack([-direction[:, 1], direction[:, 0]], axis=1)
+    bodies.addMany(r=r, m=m, v=v, colour=planetDefaultColour, size=size, fixed=False)
 
 
 def reset():
-    global bodys, bodys_m_and_r
-    bodys = []
-    bodys_m_and_r = np.empty((0, 3), dtype=np.float32)  # to speed up path prediction
+    bodies.clear()
     spawnBody(m=sunDefaultMass, colour=sunDefaultColour, size=sunDefaultSize, is_sun=sunFixed)
 
 
-class Body:
-    def __init__(self, r, m, v, colour, size, is_sun):
-        self.m = m
-        self.r = np.array(r, dtype=np.float32)
-        self.v = mouseVelocityFactor * np.array(v, dtype=np.float32)
-        self.a = np.array([0, 0], dtype=np.float32)
-        self.colour = np.array(colour, dtype=np.int32)
-        self.size = size
-        self.is_sun = is_sun
+class Bodies:
+    """Struct-of-arrays store of every body, so a whole frame is advanced by a single kernel call.
 
-    def update(self, body_number):
-        if not self.is_sun:
-            self._update(self.r, self.v, self.a, bodys_m_and_r, body_number)
+    The public arrays are views onto buffers that double in capacity when full, so adding bodies is amortised O(1)
+    and removal swaps the last body into the gap. Every body also gets an id that stays with it however it moves in
+    the arrays, and ids of bodies merged away map to the body that absorbed them.
+    """
 
-    @staticmethod
-    @njit
-    def _update(r, v, a, m_r_array, body_number):
-        a[:] = 0
-        for i in range(m_r_array.shape[0]):
-            body_m = m_r_array[i, 0]
-            body_r = m_r_array[i, 1:]
-            delta_r = body_r - r
-            a += body_m / max(minimumDistance, delta_r.dot(delta_r)) ** (1.5) * delta_r
-
-        v += a
-        r += v
-        m_r_array[body_number, 1:] = r
+    _fields = (
+        ("r", (2,), np.float32),
+        ("v", (2,), np.float32),
+        ("a", (2,), np.float32),
+        ("m", (), np.float32),
+        ("fixed", (), np.bool_),
+        ("colour", (3,), np.int32),
+        ("size", (), np.int32),
+        ("id", (), np.int64),
+    )
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.version = 0  # bumped whenever bodies are added or removed
+        self.edited = 0  # bumped whenever bodies are added or removed other than by merging
+        self.nextId = 0
+        self.survivors = {}  # id of a merged-away body -> id of the body it merged into
+        self.steps = 0
+        self.accelerated = -1  # version for which a holds the accelerations at the current positions
+        self.forceEvaluations = 0
+        self._buffers = {name: np.zeros((capacity, *shape), dtype=dtype) for name, shape, dtype in self._fields}
+        self._views()
+
+    def __len__(self):
+        return self.count
+
+    def _views(self):
+        self.version += 1
+        for name, buffer in self._buffers.items():
+            setattr(self, name, buffer[: self.count])
+
+    def reserve(self, capacity):
+        old_capacity = self._buffers["m"].shape[0]
+        if capacity <= old_capacity:
+            return
+        capacity = max(capacity, 2 * old_capacity)
+        for name, buffer in self._buffers.items():
+            grown = np.zeros((capacity, *buffer.shape[1:]), dtype=buffer.dtype)
+            grown[: self.count] = buffer[: self.count]
+            self._buffers[name] = grown
+
+    def add(self, r, m, v, colour, size, fixed):
+        self.reserve(self.count + 1)
+        i = self.count
+        self._buffers["r"][i] = r
+        self._buffers["v"][i] = v
+        self._buffers["a"][i] = 0
+        self._buffers["m"][i] = m
+        self._buffers["fixed"][i] = fixed
+        self._buffers["colour"][i] = colour
+        self._buffers["size"][i] = size
+        self._buffers["id"][i] = self.nextId
+        self.nextId += 1
+        self.count += 1
+        self.edited += 1
+        self._views()
+
+    def addMany(self, r, m, v, colour, size, fixed):
+        k = len(r)
+        self.reserve(self.count + k)
+        new = slice(self.count, self.count + k)
+        self._buffers["r"][new] = r
+        self._buffers["v"][new] = v
+        self._buffers["a"][new] = 0
+        self._buffers["m"][new] = m
+        self._buffers["fixed"][new] = fixed
+        self._buffers["colour"][new] = colour
+        self._buffers["size"][new] = size
+        self._buffers["id"][new] = np.arange(self.nextId, self.nextId + k)
+        self.nextId += k
+        self.count += k
+        self.edited += 1
+        self._views()
+
+    def _swapRemove(self, i):
+        last = self.count - 1
+        for buffer in self._buffers.values():
+            buffer[i] = buffer[last]
+        self.count -= 1
+        self._views()
+
+    def remove(self, i):
+        self._swapRemove(i)
+        self.edited += 1
+
+    def clear(self):
+        self.count = 0
+        self.survivors.clear()
+        self.edited += 1
+        self._views()
+
+    def copy(self, which=None):
+        """A copy of every body, or of the bodies at the indices in which, keeping their ids."""
+        if which is None:
+            which = np.arange(self.count)
+        other = Bodies(capacity=max(1, len(which)))
+        other.addMany(
+            r=self.r[which],
+            m=self.m[which],
+            v=self.v[which],
+            colour=self.colour[which],
+            size=self.size[which],
+            fixed=self.fixed[which],
+        )
+        other.a[:] = self.a[which]
+        other.id[:] = self.id[which]
+        other.nextId = self.nextId
+        if self.accelerated == self.version and other.count == self.count:
+            other.accelerated = other.version
+        return other
+
+    def update(self):
+        if integrator == "leapfrog":
+            self._leapfrog(timeStep)
+        elif integrator == "block":
+            self._block_step(timeStep)
+        else:
+            self._accelerate()
+            _kick_drift(self.r, self.v, self.a, self.fixed, timeStep)
+        if gravityEngine == "particle-mesh" and meshBoundary == "periodic":
+            np.mod(self.r, np.array(screenSize, dtype=np.float32), out=self.r)
+        if mergeCollisions:
+            self.merge()
+        self.steps += 1
+
+    def merge(self):
+        """Merge overlapping bodies in pairs, conserving mass and momentum. Returns the number of merges."""
+        if self.count < 2:
+            return 0
+        cell = 2.0 * max(1.0, np.percentile(self.size, 99))
+        partner = _find_overlaps(self.r, self.size, cell)
+        gone = _merge(self.r, self.v, self.m, self.fixed, self.colour, self.size, partner)
+        self.survivors.update(zip(self.id[gone].tolist(), self.id[partner[gone]].tolist()))
+        for i in gone:
+            self._swapRemove(i)
+        return gone.shape[0]
+
+    def indices(self, ids):
+        """Current indices of the bodies with the given ids, or of the bodies they have since merged into."""
+        ids = list(ids)
+        for k, i in enumerate(ids):
+            while i in self.survivors:
+                i = self.survivors[i]
+            ids[k] = i
+        order = np.argsort(self.id)
+        return order[np.searchsorted(self.id, ids, sorter=order)]
+
+    def _accelerate(self, targets=None):
+        accelerations(self.r, self.m, self.a, targets)
+        if targets is None or gravityEngine != "direct":
+            # a tree or mesh is built over every body however few are targeted, so it costs a full evaluation
+            self.forceEvaluations += self.count
+        else:
+            self.forceEvaluations += targets.shape[0]
+
+    def _leapfrog(self, dt):
+        # kick-drift-kick, reusing the accelerations from the end of the previous step
+        if self.accelerated != self.version:
+            self._accelerate()
+            self.accelerated = self.version
+        _kick(self.v, self.a, self.fixed, 0.5 * dt)
+        _drift(self.r, self.v, self.fixed, dt)
+        self._accelerate()
+        _kick(self.v, self.a, self.fixed, 0.5 * dt)
+
+    def timestepLevels(self, dt):
+        """Block level of every body: body i steps with dt / 2 ** level[i], finer for larger accelerations."""
+        a = np.sqrt((self.a.astype(np.float64) ** 2).sum(axis=1))
+        ideal = timestepAccuracy * np.sqrt(np.sqrt(minimumDistance) / np.maximum(a, 1e-30))
+        levels = np.ceil(np.log2(dt / ideal))
+        levels = np.clip(levels, 0, blockTimestepLevels).astype(np.int64)
+        levels[self.fixed] = 0
+        return levels
+
+    def _block_step(self, dt):
+        # Hierarchical leapfrog: each body kicks and recomputes its acceleration only at the ends of its own step,
+        # while everything drifts on the finest step in use. Levels are picked when all bodies are in sync, from
+        # both ends of the step: if a body ends up needing a finer level than it started with, the step is redone
+        # at the finer level, which keeps the choice time-symmetric and stops energy drifting on close passes.
+        if self.accelerated != self.version:
+            self._accelerate()
+            self.accelerated = self.version
+        levels = self.timestepLevels(dt)
+        r, v, a = self.r.copy(), self.v.copy(), self.a.copy()
+        self._block_substeps(dt, levels)
+        end_levels = self.timestepLevels(dt)
+        if (end_levels > levels).any():
+            self.r[:], self.v[:], self.a[:] = r, v, a
+            self._block_substeps(dt, np.maximum(levels, end_levels))
+
+    def _block_substeps(self, dt, levels):
+        ticks = 1 << (int(levels.max()) if self.count else 0)
+        stride = ticks >> levels
+        half_kick = (0.5 * dt / (1 << levels))[:, None].astype(np.float32)
+        moving = ~self.fixed
+        for t in range(ticks):
+            starting = np.flatnonzero(moving & (t % stride == 0))
+            self.v[starting] += half_kick[starting] * self.a[starting]
+            _drift(self.r, self.v, self.fixed, dt / ticks)
+            ending = np.flatnonzero(moving & ((t + 1) % stride == 0))
+            if ending.shape[0]:
+                self._accelerate(ending)
+                self.v[ending] += half_kick[ending] * self.a[ending]
 
     def draw(self):
-        drawCircle(pos=self.r, colour=self.colour, size=self.size)
+        drawCircles(self.r, self.colour, self.size)
+
+
+bodies = Bodies()
+bodiesLock = threading.Lock()
+
+
+@njit("void(f4[:, ::1], f4[::1], f4[:, ::1])", cache=True, nogil=True)
+def _accelerations(r, m, a):
+    # every acceleration is computed from the same positions before anything moves
+    for i in range(r.shape[0]):
+        ax = 0.0
+        ay = 0.0
+        for j in range(r.shape[0]):
+            if i == j:
+                continue
+            dx = r[j, 0] - r[i, 0]
+            dy = r[j, 1] - r[i, 1]
+            d2 = max(minimumDistance, dx * dx + dy * dy)
+            f = m[j] / (d2 * np.sqrt(d2))
+            ax += f * dx
+            ay += f * dy
+        a[i, 0] = ax
+        a[i, 1] = ay
+
+
+@njit(cache=True, parallel=True, nogil=True)
+def _accelerations_parallel(r, m, a, chunks):
+    # each chunk takes every chunks-th row of the pair triangle and accumulates both sides of each pair into its
+    # own buffer; the buffers are then summed in chunk order, independently of which thread ran which chunk
+    n = r.shape[0]
+    buffers = np.zeros((chunks, n, 2), dtype=np.float64)
+    for c in prange(chunks):
+        for i in range(c, n, chunks):
+            for j in range(i + 1, n):
+                dx = r[j, 0] - r[i, 0]
+                dy = r[j, 1] - r[i, 1]
+                d2 = max(minimumDistance, dx * dx + dy * dy)
+                f = 1.0 / (d2 * np.sqrt(d2))
+                buffers[c, i, 0] += m[j] * f * dx
+                buffers[c, i, 1] += m[j] * f * dy
+                buffers[c, j, 0] -= m[i] * f * dx
+                buffers[c, j, 1] -= m[i] * f * dy
+    for i in prange(n):
+        ax = 0.0
+        ay = 0.0
+        for c in range(chunks):
+            ax += buffers[c, i, 0]
+            ay += buffers[c, i, 1]
+        a[i, 0] = ax
+        a[i, 1] = ay
+
+
+def _accelerations_of(r, m, a, targets):
+    for k in prange(targets.shape[0]):
+        i = targets[k]
+        ax = 0.0
+        ay = 0.0
+        for j in range(r.shape[0]):
+            if i == j:
+                continue
+            dx = r[j, 0] - r[i, 0]
+            dy = r[j, 1] - r[i, 1]
+            d2 = max(minimumDistance, dx * dx + dy * dy)
+            f = m[j] / (d2 * np.sqrt(d2))
+            ax += f * dx
+            ay += f * dy
+        a[i, 0] = ax
+        a[i, 1] = ay
+
+
+# direct-sum accelerations of just the bodies in targets, for block timesteps
+_accelerations_of_serial = njitVariant(_accelerations_of, "_accelerations_of_serial", nogil=True)
+_accelerations_of_parallel = njitVariant(_accelerations_of, "_accelerations_of_parallel", parallel=True, nogil=True)
+
+
+def accelerations(r, m, a, targets=None):
+    """Write the acceleration of every body (or only of the bodies in targets) into a, using the selected engine."""
+    if gravityEngine == "barnes-hut":
+        if targets is None:
+            targets = np.arange(r.shape[0])
+        if parallelForces:
+            barnes_hut.accelerationsParallel(r, m, a, openingAngle, minimumDistance, targets)
+        else:
+            barnes_hut.accelerations(r, m, a, openingAngle, minimumDistance, targets)
+    elif gravityEngine == "particle-mesh":
+        if targets is None:
+            targets = np.arange(r.shape[0])
+        periodic = meshBoundary == "periodic"
+        particle_mesh.accelerations(r, m, a, meshSize, periodic, screenSize, minimumDistance, targets)
+    elif targets is not None:
+        if parallelForces:
+            _accelerations_of_parallel(r, m, a, targets)
+        else:
+            _accelerations_of_serial(r, m, a, targets)
+    elif parallelForces:
+        _accelerations_parallel(r, m, a, parallelChunks)
+    else:
+        _accelerations(r, m, a)
+
+
+@njit(cache=True, nogil=True)
+def _cell_hash(x, y, mask):
+    return ((x * 73856093) ^ (y * 19349663)) & mask
+
+
+@njit(cache=True, nogil=True)
+def _overlap(r, size, i, j):
+    dx = r[j, 0] - r[i, 0]
+    dy = r[j, 1] - r[i, 1]
+    reach = size[i] + size[j]
+    return dx * dx + dy * dy < reach * reach
+
+
+@njit("i8[::1](f4[:, ::1], i4[::1], f8)", cache=True, nogil=True)
+def _find_overlaps(r, size, cell):
+    # Bodies are counting-sorted into a hashed uniform grid of the given cell size, so each one only checks the
+    # 3x3 cells around it. Bodies too big for that (2 * size > cell) check every body instead.
+    n = r.shape[0]
+    table = 1
+    while table < 2 * n:
+        table *= 2
+    mask = table - 1
+    cells = np.empty((n, 2), dtype=np.int64)
+    bucket = np.empty(n, dtype=np.int64)
+    start = np.zeros(table + 1, dtype=np.int64)
+    for i in range(n):
+        cells[i, 0] = np.int64(np.floor(r[i, 0] / cell))
+        cells[i, 1] = np.int64(np.floor(r[i, 1] / cell))
+        bucket[i] = _cell_hash(cells[i, 0], cells[i, 1], mask)
+        start[bucket[i] + 1] += 1
+    for b in range(table):
+        start[b + 1] += start[b]
+    fill = start[:-1].copy()
+    order = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        order[fill[bucket[i]]] = i
+        fill[bucket[i]] += 1
+
+    partner = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        if partner[i] != -1:
+            continue
+        if 2 * size[i] > cell:
+            for j in range(n):
+                if j != i and partner[j] == -1 and _overlap(r, size, i, j):
+                    partner[i] = j
+                    partner[j] = i
+                    break
+            continue
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                b = _cell_hash(cells[i, 0] + dx, cells[i, 1] + dy, mask)
+                for k in range(start[b], start[b + 1]):
+                    j = order[k]
+                    if partner[i] == -1 and j != i and partner[j] == -1 and _overlap(r, size, i, j):
+                        partner[i] = j
+                        partner[j] = i
+    return partner
+
+
+@njit("i8[:](f4[:, ::1], f4[:, ::1], f4[::1], b1[::1], i4[:, ::1], i4[::1], i8[::1])", cache=True, nogil=True)
+def _merge(r, v, m, fixed, colour, size, partner):
+    # each pair is folded into one survivor (a fixed body if there is one, which then stays put) and the indices
+    # to delete are returned in descending order, so swap-removing them one by one leaves the rest valid
+    gone = np.zeros(r.shape[0], dtype=np.bool_)
+    for i in range(r.shape[0]):
+        j = partner[i]
+        if j < i:
+            continue
+        keep, lose = (j, i) if fixed[j] and not fixed[i] else (i, j)
+        total = m[keep] + m[lose]
+        if not fixed[keep]:
+            for d in range(2):
+                r[keep, d] = (m[keep] * r[keep, d] + m[lose] * r[lose, d]) / total
+                v[keep, d] = (m[keep] * v[keep, d] + m[lose] * v[lose, d]) / total
+        if m[lose] > m[keep]:
+            colour[keep] = colour[lose]
+        size[keep] = int(round((size[keep] ** 3 + size[lose] ** 3) ** (1 / 3)))  # bodies are spheres
+        m[keep] = total
+        gone[lose] = True
+    return np.flatnonzero(gone)[::-1]
+
+
+@njit("void(f4[:, ::1], f4[:, ::1], f4[:, ::1], b1[::1], f8)", cache=True, nogil=True)
+def _kick_drift(r, v, a, fixed, dt):
+    for i in range(r.shape[0]):
+        if fixed[i]:
+            continue
+        v[i, 0] += a[i, 0] * dt
+        v[i, 1] += a[i, 1] * dt
+        r[i, 0] += v[i, 0] * dt
+        r[i, 1] += v[i, 1] * dt
+
+
+@njit("void(f4[:, ::1], f4[:, ::1], b1[::1], f8)", cache=True, nogil=True)
+def _kick(v, a, fixed, dt):
+    for i in range(v.shape[0]):
+        if not fixed[i]:
+            v[i, 0] += a[i, 0] * dt
+            v[i, 1] += a[i, 1] * dt
+
+
+@njit("void(f4[:, ::1], f4[:, ::1], b1[::1], f8)", cache=True, nogil=True)
+def _drift(r, v, fixed, dt):
+    for i in range(r.shape[0]):
+        if not fixed[i]:
+            r[i, 0] += v[i, 0] * dt
+            r[i, 1] += v[i, 1] * dt
+
+
+@njit(cache=True, parallel=True)
+def _energy(r, v, m, fixed):
+    # pair potential matching the softened force: -m m / d outside the softening radius, harmonic inside it
+    n = r.shape[0]
+    partial = np.zeros(n, dtype=np.float64)
+    soft = np.sqrt(minimumDistance)
+    for i in prange(n):
+        e = 0.0 if fixed[i] else 0.5 * m[i] * (v[i, 0] * v[i, 0] + v[i, 1] * v[i, 1])
+        for j in range(i + 1, n):
+            dx = r[j, 0] - r[i, 0]
+            dy = r[j, 1] - r[i, 1]
+            d2 = dx * dx + dy * dy
+            if d2 >= minimumDistance:
+                e -= m[i] * m[j] / np.sqrt(d2)
+            else:
+                e += m[i] * m[j] * (0.5 * d2 / (minimumDistance * soft) - 1.5 / soft)
+        partial[i] = e
+    return partial.sum()
+
+
+def energy():
+    """Total kinetic plus potential energy of the scene."""
+    return _energy(bodies.r, bodies.v, bodies.m, bodies.fixed)
+
+
+def randomDisk(n, seed=0):
+    """Positions and masses of n planets scattered over the field around the sun, for tests and benchmarks."""
+    if n is None:
+        n = diskBodies
+    rng = np.random.default_rng(seed)
+    radius = 0.45 * min(screenSize) * np.sqrt(rng.random(n))
+    angle = 2 * np.pi * rng.random(n)
+    r = np.empty((n + 1, 2), dtype=np.float32)
+    r[0] = screenCenter
+    r[1:, 0] = screenCenter[0] + radius * np.cos(angle)
+    r[1:, 1] = screenCenter[1] + radius * np.sin(angle)
+    m = np.full(n + 1, planetDefaultMass, dtype=np.float32)
+    m[0] = sunDefaultMass
+    return r, m
+
+
+def checkAccuracy(sizes=(1000, 10000, 100000), thetas=(0.3, 0.5, 0.7, 1.0), meshes=(128, 256, 512, 1024), samples=1000):
+    """Print Barnes-Hut and particle-mesh force errors and timings against the exact direct-sum kernel.
+
+    Errors are measured on a random sample of bodies, whose exact accelerations are cheap even for a million bodies;
+    the direct-sum time for all of them is extrapolated from the sample once the scene is too big to sum in full.
+    """
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        r, m = randomDisk(n)
+        exact = np.zeros_like(r)
+        approx = np.zeros_like(r)
+        targets = np.arange(n + 1)
+        sample = np.sort(rng.choice(n + 1, min(n + 1, samples), replace=False))
+        # compile outside the timings
+        _accelerations(r[:2], m[:2], exact[:2])
+        _accelerations_of_serial(r[:2], m[:2], exact[:2], targets[:2])
+        barnes_hut.accelerations(r[:2], m[:2], approx[:2], thetas[0], minimumDistance, targets[:2])
+        particle_mesh.accelerations(r[:2], m[:2], approx[:2], 8, False, screenSize, minimumDistance, targets[:2])
+        start = time.perf_counter()
+        if n <= 100000:
+            _accelerations(r, m, exact)
+            direct_time = time.perf_counter() - start
+            print(f"N={n}: direct {1000 * direct_time:.1f} ms")
+        else:
+            _accelerations_of_serial(r, m, exact, sample)
+            direct_time = (time.perf_counter() - start) * (n + 1) / sample.shape[0]
+            print(f"N={n}: direct ~{1000 * direct_time:.0f} ms (extrapolated from {sample.shape[0]} bodies)")
+        exact_norm = np.linalg.norm(exact[sample], axis=1)
+
+        def report(label, elapsed):
+            error = np.linalg.norm(approx[sample] - exact[sample], axis=1) / exact_norm
+            print(
+                f"  {label}: {1000 * elapsed:.1f} ms ({direct_time / elapsed:.1f}x), relative error "
+                f"median {np.median(error):.2e}, 99th {np.percentile(error, 99):.2e}, max {error.max():.2e}"
+            )
+
+        for theta in thetas:
+            start = time.perf_counter()
+            barnes_hut.accelerations(r, m, approx, theta, minimumDistance, targets)
+            report(f"theta={theta:.2f}", time.perf_counter() - start)
+        for mesh in meshes:
+            particle_mesh.accelerations(r, m, approx, mesh, False, screenSize, minimumDistance, targets)  # cache kernel
+            start = time.perf_counter()
+            particle_mesh.accelerations(r, m, approx, mesh, False, screenSize, minimumDistance, targets)
+            report(f"mesh={mesh}", time.perf_counter() - start)
+
+        # the same scene with one planet flung far away, which the fitted mesh should not stretch to cover
+        r[n] = np.array(screenCenter) + 100 * np.array(screenSize)
+        _accelerations_of_serial(r, m, exact, sample)
+        exact_norm = np.linalg.norm(exact[sample], axis=1)
+        for mesh in meshes:
+            particle_mesh.accelerations(r, m, approx, mesh, False, screenSize, minimumDistance, targets)
+            start = time.perf_counter()
+            particle_mesh.accelerations(r, m, approx, mesh, False, screenSize, minimumDistance, targets)
+            report(f"mesh={mesh}, one stray body", time.perf_counter() - start)
+
+
+class Ephemeris:
+    """Future positions of the heaviest bodies, for integrating test particles against the whole system.
+
+    A copy of the heaviest pathPredictionBodies bodies is stepped ahead of the simulation and their positions are kept
+    in a ring buffer that slides forward by one entry per simulation step, so keeping it current costs one extra step
+    of the copy per frame. The lighter bodies' pull on them is left out. Bodies are tracked by id, so merges (which the copy makes in step with the
+    simulation) do not interrupt it: a merged-away body follows the one that absorbed it. After bodies are added or
+    removed it is rebuilt, optionally over several calls.
+    """
+
+    def __init__(self, length=pathPredictionLength):
+        self.length = length
+        self.future = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.tracked = np.empty(0, dtype=np.int64)  # indices of the tracked bodies in the copy
+        self.current = np.empty(0, dtype=np.int64)  # and in the simulation, as of currentVersion
+        self.currentVersion = -1
+        self.m = np.empty(0, dtype=np.float32)
+        self.size = np.empty(0, dtype=np.int32)
+        self.positions = np.empty((length, 0, 2), dtype=np.float32)
+        self.head = 0
+        self.filled = 0
+        self.epoch = 0  # bumped whenever the recorded future changes
+        self.edited = -1
+        self.steps = 0
+
+    def sync(self, budget=None):
+        """Catch up with the simulation, then step ahead within budget body-pair interactions (None fills it)."""
+        advance = bodies.steps - self.steps
+        if bodies.edited != self.edited or not 0 <= advance <= self.filled:
+            advance = 0
+            # only the heaviest bodies are copied, so a big scene costs no more to look ahead in than a small one
+            self.edited = bodies.edited
+            heaviest = np.sort(np.argsort(bodies.m)[::-1][:pathPredictionBodies])
+            self.future = bodies.copy(heaviest)
+            self.tracked = np.arange(heaviest.shape[0])
+            self.ids = bodies.id[heaviest]
+            self.m = bodies.m[heaviest]
+            self.size = bodies.size[heaviest]
+            self.positions = np.empty((self.length, heaviest.shape[0], 2), dtype=np.float32)
+            self.head = 0
+            self.filled = 0
+            self.epoch += 1
+        elif advance:
+            self.head = (self.head + advance) % self.length
+            self.filled -= advance
+            if not bodies.fixed.all():
+                self.epoch += 1
+        self.steps = bodies.steps
+
+        steps = self.length - self.filled
+        if budget is not None:
+            n = len(self.future)
+            steps = min(steps, advance + max(1, budget // max(1, n * n)))
+        for _ in range(steps):
+            version = self.future.version
+            self.future.update()
+            if self.future.version != version:
+                self.tracked = self.future.indices(self.ids)
+            self.positions[(self.head + self.filled) % self.length] = self.future.r[self.tracked]
+            self.filled += 1
+
+    def now(self):
+        if self.currentVersion != bodies.version:
+            self.current = bodies.indices(self.ids)
+            self.currentVersion = bodies.version
+        return bodies.r[self.current]
+
+
+@njit(cache=True)
+def _positions(now, ephemeris, head, k):
+    return now if k == 0 else ephemeris[(head + k - 1) % ephemeris.shape[0]]
+
+
+@njit(cache=True)
+def _field(positions, m, x, y):
+    ax = 0.0
+    ay = 0.0
+    for j in range(m.shape[0]):
+        dx = positions[j, 0] - x
+        dy = positions[j, 1] - y
+        d2 = max(minimumDistance, dx * dx + dy * dy)
+        f = m[j] / (d2 * np.sqrt(d2))
+        ax += f * dx
+        ay += f * dy
+    return ax, ay
 
 
 class PathPrediction:
+    """Trajectory of a planet launched with the current mouse drag, integrated against every body in the scene.
+
+    The other bodies come from an Ephemeris, rebuilt over several frames at most pathPredictionBudget body-pair
+    interactions per frame. The trajectory is only re-integrated when the launch vector or the ephemeris changed,
+    and only its new tail while the ephemeris fills. It uses leapfrog at the base timestep for both leapfrog
+    integrators.
+    """
+
     def __init__(self):
         self.active = 0
         self.start = np.array([0, 0], dtype=np.float32)
@@ -95,84 +817,572 @@ class PathPrediction:
         self.v = np.array([0, 0], dtype=np.float32)
         self.a = np.array([0, 0], dtype=np.float32)
         self.path = np.zeros((pathPredictionLength, 2), dtype=np.int32)
+        self.length = 0
+        self.launch = None
+        self.ephemeris = Ephemeris()
 
     def update(self):
         if pygame.mouse.get_pressed()[0] == 1:
+            ephemeris = self.ephemeris
+            ephemeris.sync(pathPredictionBudget)
             mouse_cur_pos = pygame.mouse.get_pos()
-            self.r[:] = self.start
-            self.v = mouseVelocityFactor * (self.start - mouse_cur_pos)
+            v = mouseVelocityFactor * (self.start - np.array(mouse_cur_pos, dtype=np.float32))
+            launch = (self.start.tobytes(), v.tobytes(), ephemeris.epoch)
+            if launch != self.launch:
+                self.launch = launch
+                self.r[:] = self.start
+                self.v[:] = v
+                self.length = 0
 
             # where the magic happens
-            self._iterate(self.r, self.v, self.a, bodys_m_and_r, self.path)
+            kdk = integrator != "euler"
+            length = min(pathPredictionLength, ephemeris.filled + (0 if kdk else 1))
+            if length > self.length:
+                self._iterate(
+                    self.r,
+                    self.v,
+                    self.a,
+                    ephemeris.m,
+                    ephemeris.now(),
+                    ephemeris.positions,
+                    ephemeris.head,
+                    self.length,
+                    length,
+                    self.path,
+                    timeStep,
+                    kdk,
+                )
+                self.length = length
 
     @staticmethod
-    @njit
-    def _iterate(r, v, a, m_r_array, path_array):
-        for i in range(pathPredictionLength):
-            a[:] = 0
-            body_m = m_r_array[0, 0]
-            body_r = m_r_array[0, 1:]
-            delta_r = body_r - r
-            a += body_m / max(minimumDistance, delta_r.dot(delta_r)) ** (1.5) * delta_r
-
-            v += a
-            r += v
-            path_array[i, :] = r
+    @njit(
+        "void(f4[::1], f4[::1], f4[::1], f4[::1], f4[:, ::1], f4[:, :, ::1], i8, i8, i8, i4[:, ::1], f8, b1)",
+        cache=True,
+    )
+    def _iterate(r, v, a, m, now, ephemeris, head, first, last, path_array, dt, kdk):
+        # step k starts with the bodies where they will be after k simulation steps
+        for k in range(first, last):
+            if kdk:
+                if k == 0:
+                    a[0], a[1] = _field(now, m, r[0], r[1])
+                v[0] += 0.5 * dt * a[0]
+                v[1] += 0.5 * dt * a[1]
+                r[0] += dt * v[0]
+                r[1] += dt * v[1]
+                a[0], a[1] = _field(_positions(now, ephemeris, head, k + 1), m, r[0], r[1])
+                v[0] += 0.5 * dt * a[0]
+                v[1] += 0.5 * dt * a[1]
+            else:
+                ax, ay = _field(_positions(now, ephemeris, head, k), m, r[0], r[1])
+                v[0] += dt * ax
+                v[1] += dt * ay
+                r[0] += dt * v[0]
+                r[1] += dt * v[1]
+            path_array[k, 0] = r[0]
+            path_array[k, 1] = r[1]
 
     def draw(self):
         if self.active:
-            for i in range(0, self.path.shape[0], pathPredictionInterval):
-                drawCircle(
-                    pos=self.path[i, :], colour=pathPredictionColour, size=pathPredictionSize,
-                )
+            drawCircles(self.path[: self.length : pathPredictionInterval], pathPredictionColour, pathPredictionSize)
 
 
-def main():
-    global screen, bodys, bodys_m_and_r
+LaunchResults = namedtuple("LaunchResults", ["paths", "escaped", "collided", "collision_step", "periapsis", "steps"])
+
+
+@njit(cache=True, parallel=True)
+def _explore(
+    r0, v0, m, size, now, ephemeris, head, primary, dt, kdk, length, paths, escaped, collision_step, periapsis,
+):
+    for p in prange(r0.shape[0]):
+        x = np.float64(r0[p, 0])
+        y = np.float64(r0[p, 1])
+        vx = np.float64(v0[p, 0])
+        vy = np.float64(v0[p, 1])
+        ax, ay = _field(now, m, x, y)
+        closest = np.inf
+        hit = -1
+        for k in range(length):
+            positions = _positions(now, ephemeris, head, k)
+            if hit == -1:
+                for j in range(m.shape[0]):
+                    dx = positions[j, 0] - x
+                    dy = positions[j, 1] - y
+                    if dx * dx + dy * dy < size[j] * size[j]:
+                        hit = k
+                    if j == primary:
+                        closest = min(closest, np.sqrt(dx * dx + dy * dy))
+            if hit == -1:
+                if kdk:
+                    vx += 0.5 * dt * ax
+                    vy += 0.5 * dt * ay
+                    x += dt * vx
+                    y += dt * vy
+                    ax, ay = _field(_positions(now, ephemeris, head, k + 1), m, x, y)
+                    vx += 0.5 * dt * ax
+                    vy += 0.5 * dt * ay
+                else:
+                    ax, ay = _field(positions, m, x, y)
+                    vx += dt * ax
+                    vy += dt * ay
+                    x += dt * vx
+                    y += dt * vy
+            paths[p, k, 0] = x
+            paths[p, k, 1] = y
+        collision_step[p] = hit
+
+        # unbound from the whole system at the end of the run
+        potential = 0.0
+        positions = _positions(now, ephemeris, head, length)
+        for j in range(m.shape[0]):
+            dx = positions[j, 0] - x
+            dy = positions[j, 1] - y
+            potential -= m[j] / np.sqrt(max(minimumDistance, dx * dx + dy * dy))
+        escaped[p] = hit == -1 and 0.5 * (vx * vx + vy * vy) + potential > 0
+        periapsis[p] = closest
+
+
+def exploreLaunches(positions, velocities, length=pathPredictionLength):
+    """Integrate M test planets against the current scene in one parallel call.
+
+    positions and velocities are (M, 2) arrays, velocities in mouse-drag units as for spawnBody. Returns
+    LaunchResults with the (M, length, 2) paths, whether each planet escaped the system or hit a body (and at which
+    step, -1 if never), its closest approach to the heaviest body, and the number of steps integrated. Planets that
+    hit a body stop there. The run is cut short, with NaN paths past the end, if the ephemeris could not be
+    recorded that far.
+    """
+    ephemeris = Ephemeris(length)
+    ephemeris.sync()
+    steps = ephemeris.filled
+    if steps < length:
+        print(f"exploreLaunches: only {steps} of {length} steps could be predicted")
+    r0 = np.asarray(positions, dtype=np.float32)
+    v0 = mouseVelocityFactor * np.asarray(velocities, dtype=np.float32)
+    paths = np.full((r0.shape[0], length, 2), np.nan, dtype=np.float32)
+    escaped = np.empty(r0.shape[0], dtype=np.bool_)
+    collision_step = np.empty(r0.shape[0], dtype=np.int64)
+    periapsis = np.empty(r0.shape[0], dtype=np.float64)
+    primary = int(np.argmax(ephemeris.m))
+    _explore(
+        r0,
+        v0,
+        ephemeris.m,
+        ephemeris.size,
+        ephemeris.now(),
+        ephemeris.positions,
+        ephemeris.head,
+        primary,
+        timeStep,
+        integrator != "euler",
+        steps,
+        paths,
+        escaped,
+        collision_step,
+        periapsis,
+    )
+    return LaunchResults(paths, escaped, collision_step != -1, collision_step, periapsis, steps)
+
+
+def saveState(path, snapshots=None, snapshot_steps=None):
+    """Write every body to an .npz file that loadState (and --initial) can read back."""
+    arrays = {name: getattr(bodies, name) for name in ("r", "v", "m", "fixed", "colour", "size")}
+    if snapshots is not None:
+        arrays.update(snapshots=snapshots, snapshot_steps=snapshot_steps)
+    np.savez(path, **arrays)
+
+
+def loadState(path):
+    """Replace the scene with the bodies in an .npz file. Only r, v and m are required; v is in simulation units."""
+    state = np.load(path)
+    n = state["m"].shape[0]
+    bodies.clear()
+    bodies.addMany(
+        r=state["r"],
+        m=state["m"],
+        v=state["v"],
+        colour=state["colour"] if "colour" in state else planetDefaultColour,
+        size=state["size"] if "size" in state else planetDefaultSize,
+        fixed=state["fixed"] if "fixed" in state else np.zeros(n, dtype=np.bool_),
+    )
+
+
+def newScene(initial=None):
+    if initial is None:
+        reset()
+    else:
+        loadState(initial)
+    if startWithDisk:
+        spawnDisk()
+
+
+class Recorder:
+    """Streams body positions every few steps into a preallocated memory-mapped .npy file of shape (frames, n, 2).
+
+    Frame f holds the positions after f * every steps, copied straight from bodies.r into the mapped pages, so a run
+    never has to fit in memory. Bodies are stored in their current order, which merges shuffle; rows past the
+    current body count are NaN, and bodies beyond the n slots allocated up front are not recorded.
+    """
+
+    def __init__(self, path, steps, every=1, n=None):
+        self.every = every
+        shape = (steps // every + 1, len(bodies) if n is None else n, 2)
+        self.frames = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+        self.written = 0
+
+    def record(self, step):
+        if step % self.every or self.written == self.frames.shape[0]:
+            return
+        frame = self.frames[self.written]
+        count = min(len(bodies), frame.shape[0])
+        frame[:count] = bodies.r[:count]
+        frame[count:] = np.nan
+        self.written += 1
+
+    def close(self):
+        self.frames.flush()
+        self.frames = None
+
+
+def warmUp(draw=False):
+    """Run every kernel on a throwaway scene, so the first spawn, drag or frame does not stall on the JIT.
+
+    The kernels with explicit signatures are already compiled at import; this catches the rest, which depend on
+    the engine and rendering options. Once numba's on-disk cache is populated it only costs a few milliseconds.
+    """
+    scene = Bodies()
+    scene.addMany(r=[[0, 0], [100, 0], [101, 0]], m=1, v=0, colour=0, size=1, fixed=False)
+    scene.update()
+    scene.merge()  # the last two bodies overlap
+    scene.update()
+    if draw:
+        drawCircles(scene.r, scene.colour, scene.size)
+        path = np.zeros((2 * pathPredictionInterval, 2), dtype=np.int32)
+        drawCircles(path[::pathPredictionInterval], pathPredictionColour, pathPredictionSize)  # strided, as drawn
+
+
+def runHeadless(steps, initial=None, output=None, snapshot_every=0, report_energy=False, record=None, record_every=1):
+    """Advance the scene for a number of steps as fast as possible, without a display, and report throughput."""
+    newScene(initial)
+    recorder = Recorder(record, steps, record_every) if record is not None else None
+    initial_energy = energy() if report_energy else None
+    warmUp()  # compile the kernels outside the timed loop
+
+    # merges shrink the scene, so snapshots keep the initial body count and NaN-fill the rows past the current one
+    slots = len(bodies)
+    snapshots = []
+    snapshot_steps = []
+    body_steps = 0
+    start = time.perf_counter()
+    if recorder is not None:
+        recorder.record(0)
+    for step in range(1, steps + 1):
+        body_steps += len(bodies)
+        bodies.update()
+        if snapshot_every and step % snapshot_every == 0:
+            snapshot = np.full((slots, 2), np.nan, dtype=np.float32)
+            snapshot[: min(len(bodies), slots)] = bodies.r[:slots]
+            snapshots.append(snapshot)
+            snapshot_steps.append(step)
+        if recorder is not None:
+            recorder.record(step)
+    elapsed = time.perf_counter() - start
+    if recorder is not None:
+        recorder.close()
+
+    print(
+        f"{steps} steps of {len(bodies)} bodies in {elapsed:.3f} s: "
+        f"{steps / elapsed:.1f} steps/s, {body_steps / elapsed:.3e} body-steps/s"
+    )
+    if report_energy:
+        final_energy = energy()
+        print(
+            f"energy {initial_energy:.6e} -> {final_energy:.6e}, "
+            f"relative drift {abs((final_energy - initial_energy) / initial_energy):.3e}, "
+            f"{bodies.forceEvaluations / max(1, body_steps):.3f} force evaluations per body-step"
+        )
+    if output is not None:
+        if snapshot_every:
+            saveState(output, np.array(snapshots), np.array(snapshot_steps))
+        else:
+            saveState(output)
+
+
+class FixedTimestep:
+    """Accumulates real time and says how many physics steps of 1 / (FRAMERATE * physicsSubsteps) are due."""
+
+    def __init__(self):
+        self.interval = 1 / (FRAMERATE * physicsSubsteps)
+        self.last = time.perf_counter()
+        self.lag = 0.0
+
+    def due(self):
+        now = time.perf_counter()
+        self.lag += now - self.last
+        self.last = now
+        most = maxCatchUp * physicsSubsteps
+        steps = min(int(self.lag / self.interval), most)
+        self.lag = 0.0 if steps == most else self.lag - steps * self.interval
+        return steps
+
+
+class FrameTimer:
+    """Per-frame timings of each part of the main loop, with rolling percentiles for the HUD and an optional CSV.
+
+    lap(section) charges the time since the previous lap to that section; endFrame() stores the frame's row, in the
+    CSV too if a path was given (one row per frame, in milliseconds).
+    """
+
+    sections = ("events", "physics", "prediction", "draw", "display", "idle")
+
+    def __init__(self, path=None, window=timingWindow):
+        self.samples = np.zeros((window, len(self.sections)))
+        self.current = np.zeros(len(self.sections))
+        self.frames = 0
+        self.last = time.perf_counter()
+        self.file = None
+        if path is not None:
+            self.file = open(path, "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(["frame"] + [f"{section}_ms" for section in self.sections])
+        self.font = None
+        self.text = []
+        self.refreshed = 0.0
+
+    def lap(self, section):
+        now = time.perf_counter()
+        self.current[self.sections.index(section)] += now - self.last
+        self.last = now
+
+    def add(self, section, seconds):
+        self.current[self.sections.index(section)] += seconds
+
+    def endFrame(self):
+        self.samples[self.frames % self.samples.shape[0]] = self.current
+        self.frames += 1
+        if self.file is not None:
+            self.writer.writerow([self.frames] + [f"{1000 * t:.3f}" for t in self.current])
+        self.current[:] = 0
+
+    def percentiles(self, q=(50, 95, 99)):
+        """Milliseconds per section at each percentile q over the last window of frames, shape (len(q), sections)."""
+        return 1000 * np.percentile(self.samples[: min(self.frames, self.samples.shape[0])], q, axis=0)
+
+    def draw(self, fps):
+        if self.frames == 0:
+            return
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        now = time.perf_counter()
+        if now - self.refreshed > 0.25:  # re-rendering text every frame would show up in the draw timings
+            self.refreshed = now
+            rows = [[f"{fps:.0f} FPS", "p50", "p95", "p99 ms"]]
+            rows += [[s] + [f"{t:.2f}" for t in times] for s, times in zip(self.sections, self.percentiles().T)]
+            self.text = [[self.font.render(cell, True, WHITE) for cell in row] for row in rows]
+        for i, row in enumerate(self.text):
+            for j, cell in enumerate(row):
+                screen.blit(cell, (8 + (90 + 50 * (j - 1) if j else 0), 8 + 16 * i))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PhysicsThread(threading.Thread):
+    """Runs the fixed-timestep loop on a worker thread; the kernels release the GIL, so it overlaps with drawing.
+
+    Each step holds bodiesLock, so the main thread can still add bodies in between. After each batch of steps the
+    positions are copied into the back buffer, which is then swapped with the front buffer that draw() reads.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.running = True
+        self.timestep = FixedTimestep()
+        self.swap_lock = threading.Lock()
+        self.front = self._snapshot(None)
+        self.back = self._snapshot(None)
+        self.busy = 0.0  # seconds spent stepping since the last busyTime() call
+
+    @staticmethod
+    def _snapshot(buffer):
+        if buffer is None or buffer[0].shape != bodies.r.shape:
+            buffer = (bodies.r.copy(), bodies.colour.copy(), bodies.size.copy(), bodies.version)
+        elif buffer[3] != bodies.version:
+            buffer[0][:] = bodies.r
+            buffer = (buffer[0], bodies.colour.copy(), bodies.size.copy(), bodies.version)
+        else:
+            buffer[0][:] = bodies.r
+        return buffer
+
+    def run(self):
+        while self.running:
+            steps = self.timestep.due()
+            start = time.perf_counter()
+            for _ in range(steps):
+                with bodiesLock:
+                    bodies.update()
+            self.busy += time.perf_counter() - start
+            if steps:
+                with bodiesLock:
+                    self.back = self._snapshot(self.back)
+                with self.swap_lock:
+                    self.front, self.back = self.back, self.front
+            else:
+                time.sleep(0.5 * self.timestep.interval)
+
+    def draw(self):
+        with self.swap_lock:
+            drawCircles(*self.front[:3])
+
+    def busyTime(self):
+        busy, self.busy = self.busy, 0.0
+        return busy
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def main(initial=None, timings=None):
+    global screen, showHud
     running = True
 
+    startup = [("imports and kernels", time.perf_counter() - importStart)]
+    start = time.perf_counter()
     pygame.init()
     clock = pygame.time.Clock()
     screen = pygame.display.set_mode(screenSize)
     pygame.display.set_caption("gravity.py")
-    bodys = []
-    bodys_m_and_r = np.empty((0, 3), dtype=np.float32)  # to speed up path prediction
-    spawnBody(m=sunDefaultMass, colour=sunDefaultColour, size=sunDefaultSize, is_sun=sunFixed)
+    newScene(initial)
+    startup.append(("window and scene", time.perf_counter() - start))
+    if warmUpKernels:
+        start = time.perf_counter()
+        warmUp(draw=True)
+        startup.append(("warm-up", time.perf_counter() - start))
     predictor = PathPrediction()
+    timestep = FixedTimestep()
+    physics = PhysicsThread() if physicsThread else None
+    if physics is not None:
+        physics.start()
+    timer = FrameTimer(timings)
+    start = time.perf_counter()
 
     while running:
+        # bodies are only changed while holding bodiesLock, in case the physics thread is stepping them
+        with bodiesLock:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+                if event.type == pygame.MOUSEBUTTONDOWN:
+                    mouse_down_pos = pygame.mouse.get_pos()
+                    predictor.active = 1
+                    predictor.start[:] = mouse_down_pos
 
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                mouse_down_pos = pygame.mouse.get_pos()
-                predictor.active = 1
-                predictor.start[:] = mouse_down_pos
+                if event.type == pygame.MOUSEBUTTONUP:
+                    mouse_up_pos = pygame.mouse.get_pos()
+                    spawnBody(
+                        r=mouse_down_pos, v=[b - a for a, b in zip(mouse_up_pos, mouse_down_pos)],
+                    )
+                    predictor.active = 0
 
-            if event.type == pygame.MOUSEBUTTONUP:
-                mouse_up_pos = pygame.mouse.get_pos()
-                spawnBody(
-                    r=mouse_down_pos, v=[b - a for a, b in zip(mouse_up_pos, mouse_down_pos)],
-                )
-                predictor.active = 0
+                if event.type == pygame.KEYUP:
+                    if event.key == pygame.K_SPACE:
+                        reset()
+                    if event.key == pygame.K_d:
+                        spawnDisk()
+                    if event.key == pygame.K_h:
+                        showHud = not showHud
 
-            if event.type == pygame.KEYUP:
-                if event.key == pygame.K_SPACE:
-                    reset()
+                if event.type == pygame.QUIT:
+                    running = False
+            timer.lap("events")
 
-            if event.type == pygame.QUIT:
-                running = False
+            if physics is None:
+                for _ in range(timestep.due()):
+                    bodies.update()
+                timer.lap("physics")
+            else:
+                # the worker's stepping overlaps with this thread, so it is charged separately from the frame time
+                timer.add("physics", physics.busyTime())
+            predictor.update()
+            timer.lap("prediction")
 
         screen.fill(BLACK)
+        if physics is None:
+            bodies.draw()
+        else:
+            physics.draw()
+        predictor.draw()
+        if showHud:
+            timer.draw(clock.get_fps())
+        timer.lap("draw")
+
+        pygame.display.update()
+        timer.lap("display")
+        if startup is not None:
+            startup.append(("first frame", time.perf_counter() - start))
+            if profileStartup:
+                phases = ", ".join(f"{name} {1000 * t:.0f} ms" for name, t in startup)
+                print(f"startup: {phases} (total {sum(t for _, t in startup):.2f} s)")
+            startup = None
+        clock.tick(FRAMERATE)
+        timer.lap("idle")
+        timer.endFrame()
+
+    timer.close()
+    if physics is not None:
+        physics.stop()
+    pygame.quit()
+    sys.exit()
 
-        for i, body in enumerate(bodys):
-            body.draw()
-            body.update(i)
 
-        predictor.update()
-        predictor.draw()
+def replay(path):
+    """Scrub through a recording made with --record, reading frames from the memory-mapped file as they are shown.
+
+    Space pauses, left/right step one frame, up/down double or halve the speed, and clicking or dragging the mouse
+    jumps to that point of the run (the bar along the bottom).
+    """
+    global screen
+    frames = np.load(path, mmap_mode="r")
+    last = frames.shape[0] - 1
+    frame = 0.0
+    speed = 1.0
+    paused = False
+    running = True
+
+    pygame.init()
+    pygame.key.set_repeat(300, 30)
+    clock = pygame.time.Clock()
+    screen = pygame.display.set_mode(screenSize)
+
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    paused = not paused
+                if event.key == pygame.K_RIGHT:
+                    frame = min(last, int(frame) + 1)
+                if event.key == pygame.K_LEFT:
+                    frame = max(0, int(frame) - 1)
+                if event.key == pygame.K_UP:
+                    speed *= 2
+                if event.key == pygame.K_DOWN:
+                    speed /= 2
+
+        if pygame.mouse.get_pressed()[0] == 1:
+            frame = last * min(1.0, max(0.0, pygame.mouse.get_pos()[0] / (screenSize[0] - 1)))
+        elif not paused:
+            frame = min(last, frame + speed)
+
+        r = np.asarray(frames[int(frame)])
+        r = r[~np.isnan(r[:, 0])]
+        screen.fill(BLACK)
+        drawCircles(r, planetDefaultColour, pathPredictionSize)
+        pygame.draw.rect(screen, pathPredictionColour, (0, screenSize[1] - 3, screenSize[0] * frame / max(1, last), 3))
+        pygame.display.set_caption(f"gravity.py replay: frame {int(frame)}/{last}{' (paused)' if paused else ''}")
 
         pygame.display.update()
         clock.tick(FRAMERATE)
@@ -182,4 +1392,83 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Simple 2D Newtonian gravity simulator")
+    parser.add_argument("--engine", choices=["direct", "barnes-hut", "particle-mesh"], default=gravityEngine)
+    parser.add_argument("--theta", type=float, default=openingAngle, help="Barnes-Hut opening angle")
+    parser.add_argument("--mesh", type=int, default=meshSize, help="particle-mesh cells across the grid")
+    parser.add_argument(
+        "--boundary", choices=["isolated", "periodic"], default=meshBoundary, help="particle-mesh boundary"
+    )
+    parser.add_argument("--parallel", action="store_true", help="evaluate forces on multiple threads")
+    parser.add_argument("--threads", type=int, help="number of threads for --parallel (implies --parallel)")
+    parser.add_argument("--disk", type=int, metavar="N", help="start with a disk of N planets around the sun")
+    parser.add_argument(
+        "--check-accuracy", action="store_true", help="compare approximate engines against direct summation and exit"
+    )
+    parser.add_argument(
+        "--check-sizes", type=int, nargs="+", default=[1000, 10000, 100000], metavar="N", help="--check-accuracy sizes"
+    )
+    parser.add_argument("--integrator", choices=["euler", "leapfrog", "block"], default=integrator)
+    parser.add_argument("--dt", type=float, default=timeStep, help="simulated time per step")
+    parser.add_argument("--energy", action="store_true", help="report energy drift in --headless mode")
+    parser.add_argument(
+        "--render", choices=["aa", "lod", "points"], default=renderMode, help="how bodies are drawn (default: lod)"
+    )
+    parser.add_argument(
+        "--substeps", type=int, default=physicsSubsteps, help="physics steps per frame at the nominal frame rate"
+    )
+    parser.add_argument("--physics-thread", action="store_true", help="step the physics on a worker thread")
+    parser.add_argument(
+        "--warm-up", action=argparse.BooleanOptionalAction, default=warmUpKernels, help="compile kernels at startup"
+    )
+    parser.add_argument("--profile-startup", action="store_true", help="print how long startup took")
+    parser.add_argument("--hud", action="store_true", help="show frame timings on screen (H toggles)")
+    parser.add_argument("--timings", metavar="FILE", help="write per-frame timings of each part of the loop to a CSV")
+    parser.add_argument(
+        "--merge", action=argparse.BooleanOptionalAction, default=mergeCollisions, help="merge colliding bodies"
+    )
+    parser.add_argument("--initial", metavar="FILE", help="initial conditions (.npz with r, v, m)")
+    parser.add_argument("--headless", action="store_true", help="run without a window and report throughput")
+    parser.add_argument("--steps", type=int, default=1000, help="steps to run in --headless mode")
+    parser.add_argument("--output", metavar="FILE", help="write the final state (.npz) in --headless mode")
+    parser.add_argument(
+        "--snapshot-every", type=int, default=0, metavar="K", help="also store positions every K steps in --output"
+    )
+    parser.add_argument("--record", metavar="FILE", help="stream positions to a memory-mapped .npy in --headless mode")
+    parser.add_argument("--record-every", type=int, default=1, metavar="K", help="record every K-th step")
+    parser.add_argument("--replay", metavar="FILE", help="play back a --record file instead of simulating")
+    args = parser.parse_args()
+    if args.record is not None and not args.headless:
+        parser.error("--record only works with --headless")
+    gravityEngine = args.engine
+    openingAngle = args.theta
+    meshSize = args.mesh
+    meshBoundary = args.boundary
+    integrator = args.integrator
+    renderMode = args.render
+    physicsSubsteps = args.substeps
+    physicsThread = args.physics_thread
+    mergeCollisions = args.merge
+    warmUpKernels = args.warm_up
+    profileStartup = args.profile_startup
+    showHud = args.hud
+    timeStep = args.dt
+    if args.disk is not None:
+        diskBodies = args.disk
+        startWithDisk = True
+    parallelForces = args.parallel or args.threads is not None
+    if args.threads is not None:
+        if not 1 <= args.threads <= numba.config.NUMBA_NUM_THREADS:
+            parser.error(f"--threads must be between 1 and {numba.config.NUMBA_NUM_THREADS}")
+        numba.set_num_threads(args.threads)
+
+    if args.check_accuracy:
+        checkAccuracy(args.check_sizes)
+    elif args.replay is not None:
+        replay(args.replay)
+    elif args.headless:
+        runHeadless(
+            args.steps, args.initial, args.output, args.snapshot_every, args.energy, args.record, args.record_every
+        )
+    else:
+        main(args.initial, args.timings)
@@ -0,0 +1,17 @@
+import types
+
+from numba import njit
+
+
+def njitVariant(function, name, **options):
+    """njit a copy of function registered under another name.
+
+    Numba keys its on-disk cache by a function's qualified name and bytecode but not by its compile options, so
+    a function compiled both serially and with parallel=True needs a differently named copy for each variant, or
+    one would load the other's machine code from the cache.
+    """
+    copy = types.FunctionType(
+        function.__code__, function.__globals__, name, function.__defaults__, function.__closure__
+    )
+    copy.__qualname__ = name
+    return njit(cache=True, **options)(copy)
@@ -0,0 +1,191 @@
+import numpy as np
+from numba import njit
+
+# The simulation uses 3D gravity (1/d^2 forces) restricted to a plane, so the mesh accelerations are found by
+# convolving the cloud-in-cell mass grid with the softened point-mass kernel -d / |d|^3 via FFTs, rather than by
+# inverting the 2D Laplacian (which would give 1/d forces). Isolated boundaries zero-pad the grid to twice its
+# size so nothing wraps around; periodic boundaries use the nearest image of every cell on the unpadded grid.
+# An isolated mesh is fitted to where most of the bodies are rather than to all of them, so that a few ejected
+# bodies do not stretch its cells. The forces to and from the bodies left off it go through a coarser mesh around
+# them, except for the few farthest, which would stretch that one too and are summed directly at O(N) each.
+_kernels = {}
+maxOutliers = 16
+
+
+def _greens(shape, cell, softening):
+    """FFTs of the x and y acceleration kernels on a grid of the given shape and cell size (in pixels)."""
+    key = (shape, cell, softening)
+    if key not in _kernels:
+        if len(_kernels) > 16:
+            _kernels.clear()
+        dx = np.fft.fftfreq(shape[0], 1 / shape[0])[:, None] * cell[0]  # offsets wrapped to [-n/2, n/2)
+        dy = np.fft.fftfreq(shape[1], 1 / shape[1])[None, :] * cell[1]
+        d2 = np.maximum(softening, dx * dx + dy * dy)
+        inverse = 1 / (d2 * np.sqrt(d2))
+        inverse[0, 0] = 0
+        _kernels[key] = (np.fft.rfft2(-dx * inverse), np.fft.rfft2(-dy * inverse))
+    return _kernels[key]
+
+
+@njit(cache=True, nogil=True)
+def _cloud(x, y, origin_x, origin_y, hx, hy):
+    # lower-left cell of the 2x2 block a body's unit-cell-sized cloud overlaps, and its weights along each axis
+    u = (x - origin_x) / hx - 0.5
+    v = (y - origin_y) / hy - 0.5
+    i = int(np.floor(u))
+    j = int(np.floor(v))
+    return i, j, u - i, v - j
+
+
+@njit(cache=True, nogil=True)
+def _deposit(r, m, origin_x, origin_y, hx, hy, nx, ny, periodic, grid):
+    for k in range(r.shape[0]):
+        i, j, fx, fy = _cloud(r[k, 0], r[k, 1], origin_x, origin_y, hx, hy)
+        for di in range(2):
+            for dj in range(2):
+                ii = i + di
+                jj = j + dj
+                if periodic:
+                    ii %= nx
+                    jj %= ny
+                elif not (0 <= ii < nx and 0 <= jj < ny):
+                    continue
+                w = (fx if di else 1 - fx) * (fy if dj else 1 - fy)
+                grid[ii, jj] += m[k] * w
+
+
+@njit(cache=True, nogil=True)
+def _spread(r, centre_x, centre_y, half_x, half_y):
+    # how far each body is from the centre, in units of the box's half-widths: over 1 is outside it
+    d = np.empty(r.shape[0])
+    for k in range(r.shape[0]):
+        d[k] = max(abs(r[k, 0] - centre_x) / half_x, abs(r[k, 1] - centre_y) / half_y)
+    return d
+
+
+@njit(cache=True, nogil=True)
+def _bounds(r, outside):
+    # bounding box (low x, low y, high x, high y) of the bodies not outside
+    box = np.array([np.inf, np.inf, -np.inf, -np.inf])
+    for k in range(r.shape[0]):
+        if outside[k]:
+            continue
+        x = r[k, 0]
+        y = r[k, 1]
+        box[0] = min(box[0], x)
+        box[1] = min(box[1], y)
+        box[2] = max(box[2], x)
+        box[3] = max(box[3], y)
+    return box
+
+
+@njit(cache=True, nogil=True)
+def _direct(r, m, sources, targets, softening, a):
+    # adds the pull of the bodies in sources on the bodies in targets
+    for k in range(targets.shape[0]):
+        t = targets[k]
+        ax = 0.0
+        ay = 0.0
+        for l in range(sources.shape[0]):
+            j = sources[l]
+            if j == t:
+                continue
+            dx = r[j, 0] - r[t, 0]
+            dy = r[j, 1] - r[t, 1]
+            d2 = max(softening, dx * dx + dy * dy)
+            f = m[j] / (d2 * np.sqrt(d2))
+            ax += f * dx
+            ay += f * dy
+        a[t, 0] += ax
+        a[t, 1] += ay
+
+
+@njit(cache=True, nogil=True)
+def _interpolate(r, targets, origin_x, origin_y, hx, hy, nx, ny, periodic, grid_x, grid_y, add, a):
+    for k in range(targets.shape[0]):
+        t = targets[k]
+        i, j, fx, fy = _cloud(r[t, 0], r[t, 1], origin_x, origin_y, hx, hy)
+        ax = 0.0
+        ay = 0.0
+        for di in range(2):
+            for dj in range(2):
+                ii = i + di
+                jj = j + dj
+                if periodic:
+                    ii %= nx
+                    jj %= ny
+                elif not (0 <= ii < nx and 0 <= jj < ny):
+                    continue
+                w = (fx if di else 1 - fx) * (fy if dj else 1 - fy)
+                ax += w * grid_x[ii, jj]
+                ay += w * grid_y[ii, jj]
+        if add:
+            ax += a[t, 0]
+            ay += a[t, 1]
+        a[t, 0] = ax
+        a[t, 1] = ay
+
+
+def _convolve(r, m, a, shape, cell, origin, periodic, softening, targets, add=False):
+    """Writes (or adds) the mesh accelerations from masses m into those of the bodies in targets."""
+    padded = shape if periodic else (2 * shape[0], 2 * shape[1])
+    grid = np.zeros(padded, dtype=np.float64)
+    _deposit(r, m, origin[0], origin[1], cell[0], cell[1], shape[0], shape[1], periodic, grid)
+    kernel_x, kernel_y = _greens(padded, cell, softening)
+    mass = np.fft.rfft2(grid)
+    grid_x = np.fft.irfft2(mass * kernel_x, s=padded)
+    grid_y = np.fft.irfft2(mass * kernel_y, s=padded)
+    _interpolate(
+        r, targets, origin[0], origin[1], cell[0], cell[1], shape[0], shape[1], periodic, grid_x, grid_y, add, a
+    )
+
+
+def _isolated(r, m, a, box, mesh_size, softening, targets, add=False):
+    """Writes (or adds) the accelerations from masses m on an isolated mesh fitted around box."""
+    low, high = box[:2], box[2:]
+    h = max(float((high - low).max()), 1e-3) / (mesh_size - 2)
+    h = 2 ** (np.ceil(8 * np.log2(h)) / 8)
+    origin = tuple(0.5 * (low + high) - 0.5 * mesh_size * h)
+    _convolve(r, m, a, (mesh_size, mesh_size), (h, h), origin, False, softening, targets, add)
+
+
+def accelerations(r, m, a, mesh_size, periodic, domain, softening, targets):
+    """Particle-mesh accelerations of the bodies in targets, written into a.
+
+    Periodic meshes cover the fixed domain (width, height) with mesh_size cells across; isolated meshes are
+    mesh_size x mesh_size square cells fitted around the bodies every call, with the cell size rounded up to a
+    power of 2 ** (1 / 8) so the kernel FFTs can be reused. An isolated mesh covers the 1st to 99th percentile range
+    of the positions widened by half on each side; the pulls to and from the bodies outside it go through a second,
+    coarser mesh around all of them but the maxOutliers farthest, and every pair with one of those in it is summed
+    directly.
+    """
+    if periodic:
+        shape = (mesh_size, max(1, round(mesh_size * domain[1] / domain[0])))
+        cell = (domain[0] / shape[0], domain[1] / shape[1])
+        _convolve(r, m, a, shape, cell, (0.0, 0.0), True, softening, targets)
+        return
+
+    sample = r[:: max(1, r.shape[0] // 50000)]
+    low, high = np.percentile(sample, (1, 99), axis=0)
+    centre = 0.5 * (low + high)
+    half = np.maximum(high - low, 1e-3)  # half-widths of the percentile box widened by half on each side
+    d = _spread(r, centre[0], centre[1], half[0], half[1])
+    inside = d <= 1
+    if inside.all():
+        _isolated(r, m, a, _bounds(r, ~inside), mesh_size, softening, targets)
+        return
+    far = ~inside
+    if far.sum() > maxOutliers:
+        far = d > np.partition(d, r.shape[0] - maxOutliers - 1)[r.shape[0] - maxOutliers - 1]
+    outer = ~inside & ~far
+    m_inside = np.where(inside, m, 0)
+    _isolated(r, m_inside, a, _bounds(r, ~inside), mesh_size, softening, targets[inside[targets]])
+    a[targets[~inside[targets]]] = 0
+    if outer.any():
+        box = _bounds(r, far)
+        _isolated(r, np.where(outer, m, 0), a, box, mesh_size, softening, targets[~far[targets]], True)
+        _isolated(r, m_inside, a, box, mesh_size, softening, targets[outer[targets]], True)
+    if far.any():
+        on_mesh = ~far[targets]
+        _direct(r, m, np.flatnonzero(far), targets[on_mesh], softening, a)
+        _direct(r, m, np.arange(r.shape[0]), targets[~on_mesh], softening, a)  # the farthest feel every body directly